@@ -0,0 +1,127 @@
+import socket
+import logging
+import threading
+
+# Admission control at accept time. Every accepted connection either gets
+# a Slot or is turned away on the spot with a short reply, from the accept
+# loop itself: no thread or greenlet, no table, key or handshake work is
+# spent on it. A slot counts as a handshake until the handler establishes
+# it (hands it to the relay, a mux session or a warm pool wait), then as a
+# tunnel until it is released. Two limits, 0 for none:
+#
+#   max_handshakes   handshakes in progress; what keeps key exchanges fast
+#                    under a burst, since each one is CPU bound
+#   max_tunnels      handshakes and tunnels together
+#
+# Tunnels already admitted are never touched, so their latency does not
+# depend on how many connections are being turned away. The kernel's
+# accept backlog in front of all this is bounded by "accept_backlog".
+# With --workers the limits are per worker.
+HANDSHAKE, TUNNEL, RELEASED = range(3)
+
+
+class Slot(object):
+    """ One admitted connection """
+    __slots__ = ('admission', 'state', 'detached')
+
+    def __init__(self, admission):
+        self.admission = admission      # None for a server without admission control
+        self.state = HANDSHAKE
+        self.detached = False           # someone other than the handler releases it
+
+    def established(self, detached=False):
+        """ Handshake over: from now on a tunnel. detached: released by whoever now owns it """
+        self.detached = detached
+        if self.state == HANDSHAKE and self.admission is not None:
+            self.admission._move(HANDSHAKE, TUNNEL)
+        self.state = TUNNEL
+
+    def release(self):
+        if self.state != RELEASED and self.admission is not None:
+            self.admission._move(self.state, RELEASED)
+        self.state = RELEASED
+
+
+class Admission(object):
+
+    def __init__(self, max_tunnels=0, max_handshakes=0):
+        self.max_tunnels = max_tunnels
+        self.max_handshakes = max_handshakes
+        self.lock = threading.Lock()
+        self.counts = [0, 0, 0]         # by state: handshakes, tunnels, released
+        self.rejected_handshakes = 0
+        self.rejected_tunnels = 0
+
+    def admit(self):
+        """ A Slot for a new connection, None when it is over either limit """
+        with self.lock:
+            handshakes, tunnels = self.counts[HANDSHAKE], self.counts[TUNNEL]
+            if self.max_handshakes and handshakes >= self.max_handshakes:
+                self.rejected_handshakes += 1
+                return None
+            if self.max_tunnels and handshakes + tunnels >= self.max_tunnels:
+                self.rejected_tunnels += 1
+                return None
+            self.counts[HANDSHAKE] += 1
+        return Slot(self)
+
+    def _move(self, old, new):
+        with self.lock:
+            self.counts[old] -= 1
+            self.counts[new] += 1
+
+    def stats(self):
+        handshakes, tunnels, released = self.counts
+        return {'handshakes': handshakes, 'tunnels': tunnels, 'admitted': handshakes + tunnels + released,
+                'rejected_handshakes': self.rejected_handshakes, 'rejected_tunnels': self.rejected_tunnels}
+
+
+class AdmissionServerMixin:
+    """
+    For SocketServer servers: verify_request, called from the accept loop,
+    admits the connection or sends reject_reply and drops it. Handlers find
+    their connection's Slot with slot(request); one still in its handshake,
+    or established but not detached, is released once the handler is done.
+    """
+    admission = None
+    reject_reply = b''
+    slots = None
+
+    def verify_request(self, request, client_address):
+        if self.admission is None:
+            return True
+        slot = self.admission.admit()
+        if slot is None:
+            self.reject(request)
+            return False
+        if self.slots is None:
+            self.slots = {}
+        self.slots[id(request)] = slot
+        return True
+
+    def reject(self, request):
+        try:
+            request.setblocking(0)
+            if self.reject_reply:
+                request.send(self.reject_reply)
+            request.recv(65536)         # unread data would make close() a reset the reply may not survive
+        except socket.error:
+            pass
+
+    def slot(self, request):
+        slot = self.slots.get(id(request)) if self.slots else None
+        return slot or Slot(None)
+
+    def close_request(self, request):
+        slot = self.slots.pop(id(request), None) if self.slots else None
+        if slot is not None and not slot.detached:
+            slot.release()
+        request.close()
+
+
+def load_admission(config):
+    if not (config.get('max_tunnels') or config.get('max_handshakes')):
+        return None
+    logging.info("admission: at most %s tunnels, %s handshakes"
+                 % (config.get('max_tunnels') or 'any', config.get('max_handshakes') or 'any'))
+    return Admission(config.get('max_tunnels', 0), config.get('max_handshakes', 0))
@@ -0,0 +1,244 @@
+import os
+import sys
+import hmac
+import time
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# SOCKS5 username/password checks against a user file, one user per line:
+#
+#   name:pbkdf2_sha256$iterations$salt$hash      (salt and hash base64)
+#
+# The file is read into a dict by name. A watcher re-reads it when its
+# mtime, size or inode change and swaps the whole dict in at once, so a
+# check sees either the old users or the new ones; write the file
+# elsewhere and rename it over (python auth.py add does) so no half
+# written file is ever read. Reading and the KDF run on gevent's thread
+# pool when gevent is about, so neither holds up the accept loop.
+#
+# A successful check is remembered for cache_ttl seconds under an HMAC of
+# name and password (the password itself is not kept), as long as the
+# user's record is unchanged, so clients that open a connection per
+# request pay the KDF once; checks of the same name and password that
+# arrive while one is running wait for its answer instead of running their
+# own. Failures are never cached and unknown names cost a KDF like known
+# ones.
+#
+#   python auth.py add <file> <name> [password]    add or replace a user
+#   python auth.py bench [users]                   load, check and reload rates
+SCHEME = 'pbkdf2_sha256'
+ITERATIONS = 20000
+
+
+def hash_password(password, iterations=ITERATIONS, salt=None):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return '%s$%d$%s$%s' % (SCHEME, iterations, base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+
+def parse_record(text):
+    """ (iterations, salt, digest) from hash_password's format """
+    scheme, iterations, salt, digest = text.split('$')
+    if scheme != SCHEME:
+        raise ValueError('unknown scheme %s' % scheme)
+    return int(iterations), base64.b64decode(salt), base64.b64decode(digest)
+
+
+def read_users(path):
+    users = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, sep, record = line.partition(':')
+            try:
+                users[_encode(name)] = parse_record(record)
+            except ValueError:
+                logging.warn("%s:%d: bad user record, skipped" % (path, number))
+    return users
+
+
+def _offload(func, *args):
+    """ func(*args) in a real thread when gevent has patched threading, else here """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def _encode(text):
+    return text.encode('utf-8') if not isinstance(text, bytes) else text
+
+
+class _Flight(object):
+    """ One KDF under way; later checks of the same name and password wait on it """
+    __slots__ = ('done', 'ok')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+
+class CredentialStore(object):
+
+    def __init__(self, users=None, path=None, cache_ttl=300, cache_size=65536, reload_interval=2):
+        self.users = users or {}        # name (bytes) -> (iterations, salt, digest); replaced, never changed
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.cache = OrderedDict()      # hmac(name, password) -> (expires, record)
+        self.flights = {}               # hmac(name, password) -> _Flight
+        self.secret = os.urandom(32)
+        self.dummy = parse_record(hash_password(os.urandom(8)))
+        self.lock = threading.Lock()
+        self.signature = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.reloads = 0
+
+    def start(self):
+        if self.path:
+            self.reload()
+            if self.reload_interval:
+                thread = threading.Thread(target=self._watch)
+                thread.daemon = True
+                thread.start()
+        return self
+
+    def _signature(self):
+        st = os.stat(self.path)
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def reload(self):
+        signature = self._signature()
+        users = _offload(read_users, self.path)
+        self.users = users              # one assignment: checks see old or new, never a mix
+        self.signature = signature
+        self.reloads += 1
+        logging.info("loaded %d users from %s" % (len(users), self.path))
+
+    def _watch(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                if self._signature() != self.signature:
+                    self.reload()
+            except (IOError, OSError) as e:
+                logging.warn("users file: %s" % e)
+
+    def verify(self, name, password):
+        name, password = _encode(name), _encode(password)
+        record = self.users.get(name)
+        key = hmac.new(self.secret, name + b'\0' + password, hashlib.sha256).digest()
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now and entry[1] == record:
+                self.hits += 1
+                return True
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+        if not leader:
+            self.coalesced += 1
+            flight.done.wait()
+            return flight.ok
+        self.misses += 1
+        try:
+            iterations, salt, digest = record or self.dummy
+            flight.ok = hmac.compare_digest(_offload(hashlib.pbkdf2_hmac, 'sha256', password, salt, iterations),
+                                            digest) and record is not None
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if flight.ok:
+                    self.cache.pop(key, None)
+                    self.cache[key] = (now + self.cache_ttl, record)
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            flight.done.set()
+        if not flight.ok:
+            self.failures += 1
+        return flight.ok
+
+    def stats(self):
+        return {'users': len(self.users), 'cached': len(self.cache), 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced, 'failures': self.failures, 'reloads': self.reloads}
+
+
+def load_credentials(config, username, password):
+    """ users_file when configured, else the single built-in user """
+    path = config.get('users_file')
+    users = None if path else {_encode(username): parse_record(hash_password(_encode(password)))}
+    return CredentialStore(users, path, config.get('auth_cache_ttl', 300),
+                           config.get('auth_cache_size', 65536), config.get('users_reload', 2)).start()
+
+
+def add_user(path, name, password, iterations=ITERATIONS):
+    """ Rewrite path with name added or replaced, by rename so readers never see half a file """
+    lines = []
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = [line for line in f if line.partition(':')[0] != name]
+    lines.append('%s:%s\n' % (name, hash_password(_encode(password), iterations)))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.rename(tmp, path)
+
+
+def _bench(count):
+    import tempfile
+    path = tempfile.mktemp(suffix='.users')
+    salt = os.urandom(16)
+    start = time.time()
+    with open(path, 'w') as f:          # 1 iteration: the file's size matters here, not its KDF
+        for i in range(count):
+            f.write('user%d:%s\n' % (i, hash_password(b'pass%d' % i, 1, salt)))
+    print('wrote %d users in %.2f s' % (count, time.time() - start))
+    store = CredentialStore(path=path, reload_interval=0).start()
+    start = time.time()
+    store.reload()
+    print('load %d users          %8.3f s' % (count, time.time() - start))
+
+    names = [('user%d' % i, 'pass%d' % i) for i in range(0, count, max(1, count // 1000))]
+    for label, run in [('check, KDF (1 iter)', lambda: [store.verify(n, p) for n, p in names]),
+                       ('check, cached', lambda: [store.verify(n, p) for n, p in names])]:
+        start = time.time()
+        assert all(run())
+        print('%-24s %8.0f checks/s' % (label, len(names) / (time.time() - start)))
+    assert not store.verify('user1', 'wrong') and not store.verify('nobody', 'x')
+
+    record = parse_record(hash_password(b'x'))
+    start = time.time()
+    for i in range(5):
+        hashlib.pbkdf2_hmac('sha256', b'x', record[1], record[0])
+    print('check, KDF (%d iter)  %8.0f checks/s' % (ITERATIONS, 5 / (time.time() - start)))
+
+    add_user(path, 'user0', 'changed', 1)
+    start = time.time()
+    store.reload()
+    print('reload after a change    %8.3f s' % (time.time() - start))
+    assert store.verify('user0', 'changed') and not store.verify('user0', 'pass0')
+    os.unlink(path)
+    print(store.stats())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'add':
+        import getpass
+        password = sys.argv[4] if len(sys.argv) > 4 else getpass.getpass('password for %s: ' % sys.argv[3])
+        add_user(sys.argv[2], sys.argv[3], password)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        _bench(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    else:
+        print('usage: auth.py add <file> <name> [password] | auth.py bench [users]')
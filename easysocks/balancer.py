@@ -0,0 +1,158 @@
+import time
+import random
+import socket
+import logging
+import gevent
+
+# Spreads new tunnels over the configured servers. Each server keeps an
+# EWMA of its handshake time (connect through key exchange) and of its
+# failure rate; a pick takes two servers at random and uses the cheaper
+# one (power of two choices), cost being latency times the work already on
+# it, inflated by failures. Servers never measured cost nothing, so they
+# are tried first.
+#
+# Circuit breaker: `failures` failures in a row open a server for
+# `cooldown` seconds (doubling up to max_cooldown while it keeps failing).
+# After that one pick or probe is let through (half-open); success closes
+# the breaker, failure opens it again. When every server is open the one
+# due soonest is used anyway rather than failing outright.
+#
+# A probe greenlet times a bare TCP connect to servers that no real
+# handshake has measured for probe_interval seconds, so idle and recovering
+# servers are not judged on stale numbers.
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+
+class Upstream(object):
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.rtt = None                 # EWMA of handshake time, seconds
+        self.failure_rate = 0.0         # EWMA of 1 per failed attempt, 0 per good one
+        self.failures = 0               # in a row
+        self.pending = 0                # connects and handshakes under way
+        self.tunnels = 0                # tunnels being relayed through it
+        self.state = CLOSED
+        self.cooldown = 0
+        self.retry_at = 0
+        self.sampled = 0                # when rtt was last updated
+        self.picks = 0
+        self.failed = 0
+        self.declined = 0
+
+    def cost(self):
+        if self.rtt is None:
+            return 0.0
+        return self.rtt * (self.pending + self.tunnels + 1) / max(1.0 - self.failure_rate, 0.05)
+
+    def __str__(self):
+        return '%s:%d' % self.address
+
+    def stats(self):
+        return {'rtt_ms': self.rtt * 1000.0 if self.rtt is not None else None,
+                'failure_rate': self.failure_rate, 'state': self.state, 'tunnels': self.tunnels,
+                'picks': self.picks, 'failed': self.failed, 'declined': self.declined}
+
+
+class Balancer(object):
+    """ Not locked: local.py's greenlets are its only users """
+
+    def __init__(self, servers, decay=0.3, failures=3, cooldown=10, max_cooldown=300,
+                 probe_interval=30, connect_timeout=5):
+        self.upstreams = [Upstream(host, int(port)) for host, port in servers]
+        self.decay = decay
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_interval = probe_interval
+        self.connect_timeout = connect_timeout
+
+    def start(self):
+        if len(self.upstreams) > 1 and self.probe_interval:
+            gevent.spawn(self._probe_loop)
+        return self
+
+    def pick(self, exclude=()):
+        now = time.time()
+        candidates = [u for u in self.upstreams if u not in exclude] or self.upstreams
+        ready = [u for u in candidates if u.state == CLOSED or u.state == OPEN and now >= u.retry_at]
+        if not ready:
+            upstream = min(candidates, key=lambda u: u.retry_at)
+        elif len(ready) == 1:
+            upstream = ready[0]
+        else:
+            a, b = random.sample(ready, 2)
+            upstream = a if a.cost() <= b.cost() else b
+        if upstream.state == OPEN:
+            upstream.state = HALF_OPEN      # this pick is the trial
+        upstream.picks += 1
+        return upstream
+
+    def begin(self, upstream):
+        upstream.pending += 1
+
+    def succeeded(self, upstream, rtt=None):
+        """ A connect and handshake that started with begin() worked; rtt None: no sample """
+        upstream.pending -= 1
+        upstream.failures = 0
+        upstream.failure_rate *= 1.0 - self.decay
+        if rtt is not None:
+            upstream.rtt = rtt if upstream.rtt is None else upstream.rtt + self.decay * (rtt - upstream.rtt)
+            upstream.sampled = time.time()
+        if upstream.state != CLOSED:
+            logging.info("upstream %s recovered" % upstream)
+            upstream.state = CLOSED
+            upstream.cooldown = 0
+
+    def failed(self, upstream):
+        upstream.pending -= 1
+        upstream.failures += 1
+        upstream.failed += 1
+        upstream.failure_rate += self.decay * (1.0 - upstream.failure_rate)
+        if upstream.state == HALF_OPEN or upstream.state == CLOSED and upstream.failures >= self.failures:
+            upstream.cooldown = min(upstream.cooldown * 2 or self.cooldown, self.max_cooldown)
+            upstream.retry_at = time.time() + upstream.cooldown
+            upstream.state = OPEN
+            logging.warn("upstream %s failing, skipped for %ds" % (upstream, upstream.cooldown))
+
+    def declined(self, upstream):
+        """ The server answered but turned the tunnel down (destination unreachable, busy): up, not failing """
+        upstream.declined += 1
+        self.succeeded(upstream)
+
+    def opened(self, upstream):
+        upstream.tunnels += 1
+
+    def closed(self, upstream):
+        upstream.tunnels -= 1
+
+    def _probe_loop(self):
+        while True:
+            gevent.sleep(self.probe_interval / 2.0)
+            now = time.time()
+            for upstream in self.upstreams:
+                if upstream.state == CLOSED and now - upstream.sampled >= self.probe_interval \
+                        or upstream.state == OPEN and now >= upstream.retry_at:
+                    gevent.spawn(self.probe, upstream)
+
+    def probe(self, upstream):
+        if upstream.state == OPEN:
+            upstream.state = HALF_OPEN
+        self.begin(upstream)
+        start = time.time()
+        try:
+            sock = socket.create_connection(upstream.address, self.connect_timeout)
+        except socket.error:
+            self.failed(upstream)
+            return
+        sock.close()
+        self.succeeded(upstream, time.time() - start)
+
+    def stats(self):
+        return dict((str(u), u.stats()) for u in self.upstreams)
+
+
+def load_balancer(config, servers):
+    return Balancer(servers, config.get('balance_decay', 0.3), config.get('breaker_failures', 3),
+                    config.get('breaker_cooldown', 10), config.get('breaker_max_cooldown', 300),
+                    config.get('probe_interval', 30), config.get('connect_timeout', 10)).start()
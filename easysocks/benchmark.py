@@ -0,0 +1,347 @@
+import gevent, gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import re
+import sys
+import json
+import time
+import struct
+import socket
+import getopt
+import tempfile
+import subprocess
+
+# Loopback benchmark of the whole pipeline: starts server.py and local.py
+# on spare ports next to an in-process origin, drives concurrent SOCKS5
+# clients through them and prints one JSON document, so runs on different
+# commits can be diffed without any network.
+#
+#   python2 benchmark.py [-n clients] [-b MB per bulk stream] [-s streams]
+#                        [-w warmup seconds] [--workers N] [-c cipher] [-o out.json]
+#
+# Setup latency is split into what the client sees (greeting, auth,
+# request, first echoed byte, then a plain round trip) and what local.py
+# logs for each tunnel (connect to server, key exchange, cipher setup; warm
+# connections have the first two done in advance). Bulk runs upload and
+# download separately; CPU seconds per GB and peak RSS are read from /proc
+# for the proxy processes (and their workers).
+#
+# The origin speaks a tiny protocol: 'E' echoes, 'S' + size sinks size
+# bytes then answers one byte, 'D' + size sends size bytes.
+HERE = os.path.dirname(os.path.abspath(__file__))
+USERNAME = 'username'
+PASSWORD = 'password'
+SETUP_LINE = re.compile(r'tunnel setup via \S+: (?:connect ([\d.]+) ms, key exchange ([\d.]+) ms|warm connection), '
+                        r'cipher ([\d.]+) ms')
+BLOCK = os.urandom(1 << 16)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def recv_exact(sock, n):
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise socket.error('connection closed')
+        data += chunk
+    return data
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1],
+            'mean': sum(values) / len(values)}
+
+
+class Origin(object):
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        gevent.spawn(self._serve)
+        return self
+
+    def _serve(self):
+        while True:
+            conn, peer = self.sock.accept()
+            gevent.spawn(self._handle, conn)
+
+    def _handle(self, conn):
+        try:
+            mode = recv_exact(conn, 1)
+            if mode == 'E':
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            elif mode == 'S':
+                left = struct.unpack('>Q', recv_exact(conn, 8))[0]
+                while left:
+                    data = conn.recv(min(left, 1 << 18))
+                    if not data:
+                        break
+                    left -= len(data)
+                conn.sendall('k')
+            elif mode == 'D':
+                left = struct.unpack('>Q', recv_exact(conn, 8))[0]
+                while left:
+                    n = min(left, len(BLOCK))
+                    conn.sendall(BLOCK[:n])
+                    left -= n
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+class Proxy(object):
+    """ One of the proxy scripts as a child process, its log in a temp file """
+
+    def __init__(self, script, args):
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, script)] + args,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def pids(self):
+        """ The process and its --workers children """
+        pids = [self.process.pid]
+        for pid in pids:
+            try:
+                for task in os.listdir('/proc/%d/task' % pid):
+                    with open('/proc/%d/task/%s/children' % (pid, task)) as f:
+                        pids.extend(int(child) for child in f.read().split())
+            except (IOError, OSError):
+                pass
+        return pids
+
+    def cpu(self):
+        """ User + system CPU seconds of all its processes """
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except (IOError, OSError):
+                pass
+        return float(total) / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss(self):
+        """ Sum of VmHWM over its processes, in KB """
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total += int(line.split()[1])
+            except (IOError, OSError):
+                pass
+        return total
+
+    def output(self):
+        self.log.seek(0)
+        return self.log.read()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def wait_listening(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            gevent.sleep(0.1)
+    raise RuntimeError('nothing listening on port %d' % port)
+
+
+def open_tunnel(local_port, origin_port, timings=None):
+    """ A SOCKS5 CONNECT through local.py to the origin; timings gets each step in ms """
+    marks = [time.time()]
+    sock = socket.create_connection(('127.0.0.1', local_port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall('\x05\x01\x02')
+    if recv_exact(sock, 2) != '\x05\x02':
+        raise socket.error('greeting refused')
+    marks.append(time.time())
+    sock.sendall('\x01%c%s%c%s' % (len(USERNAME), USERNAME, len(PASSWORD), PASSWORD))
+    if recv_exact(sock, 2) != '\x01\x00':
+        raise socket.error('auth refused')
+    marks.append(time.time())
+    sock.sendall('\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', origin_port))
+    if recv_exact(sock, 10)[1] != '\x00':
+        raise socket.error('request refused')
+    marks.append(time.time())
+    if timings is not None:
+        for name, a, b in zip(('greeting', 'auth', 'request'), marks, marks[1:]):
+            timings[name] = (b - a) * 1000
+    return sock
+
+
+def setup_client(local_port, origin_port, results):
+    timings = {}
+    start = time.time()
+    try:
+        sock = open_tunnel(local_port, origin_port, timings)
+        mark = time.time()
+        sock.sendall('Ex')
+        recv_exact(sock, 1)
+        timings['first_byte'] = (time.time() - mark) * 1000
+        mark = time.time()
+        sock.sendall('y')
+        recv_exact(sock, 1)
+        timings['rtt'] = (time.time() - mark) * 1000
+        timings['total'] = (time.time() - start) * 1000
+        sock.close()
+    except socket.error:
+        timings = None
+    results.append(timings)
+
+
+def upload(local_port, origin_port, size):
+    sock = open_tunnel(local_port, origin_port)
+    start = time.time()
+    sock.sendall('S' + struct.pack('>Q', size))
+    view = memoryview(BLOCK)
+    left = size
+    while left:
+        n = min(left, len(BLOCK))
+        sock.sendall(view[:n])
+        left -= n
+    recv_exact(sock, 1)
+    sock.close()
+    return time.time() - start
+
+
+def download(local_port, origin_port, size):
+    sock = open_tunnel(local_port, origin_port)
+    start = time.time()
+    sock.sendall('D' + struct.pack('>Q', size))
+    left = size
+    while left:
+        data = sock.recv(1 << 18)
+        if not data:
+            raise socket.error('short download')
+        left -= len(data)
+    sock.close()
+    return time.time() - start
+
+
+def bulk(proxies, run, local_port, origin_port, size, streams):
+    """ MB/s over `streams` parallel tunnels, and CPU seconds per GB for each proxy """
+    before = [p.cpu() for p in proxies]
+    start = time.time()
+    jobs = [gevent.spawn(run, local_port, origin_port, size) for i in range(streams)]
+    gevent.joinall(jobs, raise_error=True)
+    elapsed = time.time() - start
+    gb = size * streams / 1e9
+    return {'mb_per_s': size * streams / elapsed / 1e6, 'seconds': elapsed, 'bytes': size * streams,
+            'cpu_s_per_gb': dict((p.name, (p.cpu() - b) / gb) for p, b in zip(proxies, before))}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    opts, args = getopt.getopt(sys.argv[1:], 'n:b:s:w:o:c:', ['workers='])
+    clients, mb, streams, warmup, output, workers, cipher = 100, 256, 1, 2.0, None, 1, None
+    for key, value in opts:
+        if key == '-n':
+            clients = int(value)
+        elif key == '-b':
+            mb = int(value)
+        elif key == '-s':
+            streams = int(value)
+        elif key == '-w':
+            warmup = float(value)
+        elif key == '-o':
+            output = value
+        elif key == '--workers':
+            workers = int(value)
+        elif key == '-c':
+            cipher = value
+
+    origin = Origin().start()
+    server_port, local_port = free_port(), free_port()
+    extra = ['--workers', str(workers)] if workers > 1 else []
+    if cipher:
+        extra += ['--cipher', cipher]
+    server = Proxy('server.py', ['-p', str(server_port)] + extra)
+    server.name = 'server'
+    local = Proxy('local.py', ['-l', str(local_port), '-s', '127.0.0.1', '-p', str(server_port)] + extra)
+    local.name = 'local'
+    proxies = [local, server]
+    try:
+        wait_listening(server_port)
+        wait_listening(local_port)
+        gevent.sleep(warmup)                # key pools and warm connections fill up
+
+        results = []
+        start = time.time()
+        gevent.joinall([gevent.spawn(setup_client, local_port, origin.port, results) for i in range(clients)])
+        setup_seconds = time.time() - start
+        ok = [r for r in results if r]
+        setup = {'clients': clients, 'failed': clients - len(ok), 'seconds': setup_seconds}
+        for name in ('greeting', 'auth', 'request', 'first_byte', 'rtt', 'total'):
+            setup[name + '_ms'] = percentiles([r[name] for r in ok])
+
+        size = mb << 20
+        report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'params': {'clients': clients, 'bulk_mb': mb, 'streams': streams, 'workers': workers,
+                             'cipher': cipher or 'table'},
+                  'setup': setup,
+                  'upload': bulk(proxies, upload, local_port, origin.port, size, streams),
+                  'download': bulk(proxies, download, local_port, origin.port, size, streams)}
+        gevent.sleep(0.5)                   # let local.py log the last tunnels
+        report['peak_rss_kb'] = dict((p.name, p.peak_rss()) for p in proxies)
+    finally:
+        for p in proxies:
+            p.stop()
+
+    connect, exchange, cipher_setup, warm = [], [], [], 0
+    for match in SETUP_LINE.finditer(local.output()):
+        if match.group(1) is None:
+            warm += 1
+        else:
+            connect.append(float(match.group(1)))
+            exchange.append(float(match.group(2)))
+        cipher_setup.append(float(match.group(3)))
+    setup.update({'warm_tunnels': warm, 'connect_ms': percentiles(connect),
+                  'key_exchange_ms': percentiles(exchange), 'cipher_ms': percentiles(cipher_setup)})
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    print text
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+from collections import deque
+
+
+class Buffer(object):
+    """ A fixed bytearray and a memoryview of it, made once """
+    __slots__ = ('data', 'view')
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+
+class BufferPool(object):
+    """
+    Free list of Buffers of one size. Not locked: each relay loop owns its
+    pool. At most `keep` free buffers are held on to, the rest are dropped.
+    """
+
+    def __init__(self, size, keep=256):
+        self.size = size
+        self.keep = keep
+        self.free = deque()
+        self.allocated = 0
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        if self.free:
+            return self.free.pop()
+        self.allocated += 1
+        return Buffer(self.size)
+
+    def release(self, buf):
+        if len(self.free) < self.keep:
+            self.free.append(buf)
+
+    def stats(self):
+        return {'size': self.size, 'free': len(self.free),
+                'allocated': self.allocated, 'acquired': self.acquired}
+
@@ -0,0 +1,175 @@
+import os
+import time
+import errno
+import socket
+import select
+import threading
+from collections import OrderedDict
+from stats import Histogram
+
+# Happy eyeballs (RFC 8305) for the server's outbound connects: every A and
+# AAAA record of the destination is a candidate, families alternate, and a
+# new attempt starts every attempt_delay seconds (or as soon as one fails)
+# while earlier ones are still pending. The first to connect wins, the rest
+# are closed. The winning address is remembered per (host, port) for
+# cache_ttl seconds and tried first next time, so a blackholed address
+# costs one attempt_delay once rather than a connect timeout every time.
+_PENDING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, errno.EALREADY)
+
+
+def interleave(addrs, first=socket.AF_INET6):
+    """ Alternate address families, starting with `first` (RFC 8305 section 4) """
+    ours = [a for a in addrs if a[0] == first]
+    others = [a for a in addrs if a[0] != first]
+    ordered = []
+    for i in range(max(len(ours), len(others))):
+        ordered.extend(ours[i:i + 1])
+        ordered.extend(others[i:i + 1])
+    return ordered
+
+
+class Connector(object):
+    """ connect(host, port, timeout) -> connected blocking socket; socket.timeout past the deadline """
+
+    def __init__(self, resolver, attempt_delay=0.25, cache_size=4096, cache_ttl=600):
+        self.resolver = resolver
+        self.attempt_delay = attempt_delay
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.winners = OrderedDict()            # (host, port) -> (expires, (family, address))
+        self.lock = threading.Lock()
+        self.latency = Histogram()
+        self.family_latency = {socket.AF_INET: Histogram(), socket.AF_INET6: Histogram()}
+        self.connects = 0
+        self.attempts = 0
+        self.raced = 0                          # connects that had more than one attempt going
+        self.fallbacks = 0                      # ... won by other than the first candidate
+        self.failed = 0
+
+    def order(self, host, port, addrs):
+        with self.lock:
+            entry = self.winners.get((host, port))
+        if entry is None or time.time() >= entry[0] or entry[1] not in addrs:
+            return interleave(addrs)
+        winner = entry[1]
+        return [winner] + interleave([a for a in addrs if a != winner], winner[0])
+
+    def connect(self, host, port, timeout=None):
+        start = time.time()
+        deadline = start + timeout if timeout else None
+        candidates = self.order(host, port, self.resolver.resolve(host))
+        first = candidates[0]
+        pending = {}                            # sock -> (family, address)
+        started = 0
+        next_at = start
+        error = None
+        try:
+            while candidates or pending:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    self.failed += 1
+                    raise socket.timeout('connect to %s:%d timed out' % (host, port))
+                if candidates and (now >= next_at or not pending):
+                    family, address = candidate = candidates.pop(0)
+                    self.attempts += 1
+                    started += 1
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(0)
+                    err = sock.connect_ex((address, port))
+                    if err == 0:
+                        return self._won(sock, host, port, candidate, first, started, start)
+                    if err in _PENDING:
+                        pending[sock] = candidate
+                        next_at = now + self.attempt_delay
+                    else:
+                        sock.close()
+                        error = socket.error(err, os.strerror(err))
+                    continue
+                waits = [next_at - now] if candidates else []
+                if deadline is not None:
+                    waits.append(deadline - now)
+                r, w, x = select.select([], list(pending), [], max(0, min(waits)) if waits else None)
+                for sock in w:
+                    candidate = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return self._won(sock, host, port, candidate, first, started, start)
+                    sock.close()
+                    error = socket.error(err, os.strerror(err))
+                    next_at = time.time()       # a refusal starts the next attempt now
+            self.failed += 1
+            raise error or socket.error('no address for %s:%d' % (host, port))
+        finally:
+            for sock in pending:
+                sock.close()
+
+    def _won(self, sock, host, port, candidate, first, started, start):
+        sock.setblocking(1)
+        now = time.time()
+        self.connects += 1
+        self.raced += started > 1
+        self.fallbacks += candidate != first
+        self.latency.observe_since(start, now)
+        self.family_latency[candidate[0]].observe_since(start, now)
+        with self.lock:
+            self.winners.pop((host, port), None)
+            self.winners[(host, port)] = (now + self.cache_ttl, candidate)
+            while len(self.winners) > self.cache_size:
+                self.winners.popitem(last=False)
+        return sock
+
+    def stats(self):
+        return {'connects': self.connects, 'attempts': self.attempts, 'raced': self.raced,
+                'fallbacks': self.fallbacks, 'failed': self.failed, 'remembered': len(self.winners),
+                'latency_ms': self.latency.stats(),
+                'ipv4_ms': self.family_latency[socket.AF_INET].stats(),
+                'ipv6_ms': self.family_latency[socket.AF_INET6].stats()}
+
+
+def load_connector(config, resolver):
+    return Connector(resolver, config.get('connect_attempt_delay', 0.25),
+                     cache_ttl=config.get('connect_cache_ttl', 600))
+
+
+if __name__ == '__main__':
+    from resolver import Resolver, StubServer, A, AAAA
+    live4 = socket.socket(socket.AF_INET)
+    live4.bind(('127.0.0.1', 0))
+    live4.listen(128)
+    port = live4.getsockname()[1]
+    live6 = socket.socket(socket.AF_INET6)
+    live6.bind(('::1', port))
+    live6.listen(128)
+    hole = socket.socket(socket.AF_INET)        # a full accept queue drops SYNs: a blackhole
+    hole.bind(('127.0.0.2', port))
+    hole.listen(0)
+    filler = []
+    for i in range(4):
+        s = socket.socket()
+        s.setblocking(0)
+        s.connect_ex(('127.0.0.2', port))
+        filler.append(s)
+    time.sleep(0.2)
+
+    stub = StubServer({'race.test': [(A, '127.0.0.2', 60), (A, '127.0.0.1', 60)],
+                       'dual.test': [(A, '127.0.0.1', 60), (AAAA, '::1', 60)],
+                       'dead.test': [(A, '127.0.0.2', 60)]}).start()
+    connector = Connector(Resolver([stub.address], hosts={}), attempt_delay=0.25)
+
+    for name in ['race.test', 'race.test', 'dual.test', 'dual.test', '127.0.0.1']:
+        start = time.time()
+        sock = connector.connect(name, port, timeout=3)
+        print('%-10s -> %-12s %6.1f ms' % (name, sock.getpeername()[0], (time.time() - start) * 1000))
+        sock.close()
+    start = time.time()
+    plain = socket.socket()
+    plain.settimeout(1)
+    try:
+        plain.connect(('127.0.0.2', port))
+    except socket.timeout:
+        print('single connect to the blackhole: timed out after %.1f s' % (time.time() - start))
+    try:
+        connector.connect('dead.test', port, timeout=0.5)
+    except socket.timeout as e:
+        print('dead.test: %s' % e)
+    print(connector.stats())
@@ -0,0 +1,250 @@
+import os
+import hmac
+import errno
+import socket
+import struct
+import hashlib
+import numpy as np
+from rsa import CODECS
+from ticket import binder, BINDER_SIZE
+
+# Handshake v2: one flight each way, as length-prefixed frames.
+#
+#   client: HANDSHAKE_V2 ADDR PUBKEY IDENT SHARE [TICKET] [OWNER] END
+#   server: STATUS PUBKEY IDENT SHARE TICKET END     (full exchange)
+#           STATUS RESUMED END                       (ticket accepted)
+#
+# A resuming client still sends a full hello, so a ticket the server has
+# forgotten costs nothing but the RSA work it would have done anyway.
+# The whole flight is wrapped in the password table like the legacy address,
+# so it carries no application data: that follows under the session key.
+# The legacy protocol opens with an address type (1, 3 or 4), so the first
+# byte is enough for the server to tell the two apart.
+HANDSHAKE_V2 = 0x82
+
+F_ADDR = 1          # ATYP [len] addr port, as in the legacy address
+F_PUBKEY = 2        # RSA.pack_pubkey()
+F_IDENT = 3         # client: signed id_seq + CLIENT_ID; server: id_seq + 1 + SERVER_ID, encrypted to the client
+F_SHARE = 4         # client: random; server: random, signed and encrypted to the client
+F_DATA = 5          # early application data, after F_DEFER only (older clients put it in the first flight)
+F_STATUS = 6        # server: STATUS_*
+F_END = 7
+F_TICKET = 8        # client: ticket + binder(key, share); server: new ticket
+F_RESUMED = 9       # server: the ticket's key is reused, nothing else follows
+F_MUX = 10          # client, instead of F_ADDR: the connection becomes a mux tunnel (mux.py)
+F_DEFER = 11        # client, instead of F_ADDR: ADDR [DATA] END follows later under the session key
+F_OWNER = 12        # client, with ADDR: opaque tag of the SOCKS user, keys origin connection reuse
+
+STATUS_OK = 0
+STATUS_UNREACHABLE = 1
+STATUS_REJECTED = 2
+STATUS_BUSY = 3         # server over its admission limits, try again or elsewhere
+
+CLIENT_ID = '2017013684'
+SERVER_ID = '2017011303'
+MAX_FRAME = 0xffff
+
+codec = CODECS['block']
+
+
+class HandshakeError(Exception):
+    pass
+
+
+class HandshakeClosed(HandshakeError):
+    pass
+
+
+class HandshakeRefused(HandshakeClosed):
+    """ The peer hung up, or reset, before its first byte: what a server without v2 does """
+    pass
+
+
+class ServerBusy(HandshakeError):
+    """ STATUS_BUSY: the server is shedding load """
+    pass
+
+
+def recv_exact(sock, n):
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise HandshakeClosed('connection closed')
+        data += chunk
+    return data
+
+
+def pack_frame(ftype, payload):
+    return struct.pack('!BH', ftype, len(payload)) + payload
+
+
+def read_frames(sock, decrypt):
+    """ Read frames up to F_END, returns {type: payload} """
+    try:
+        first = recv_exact(sock, 1)
+    except HandshakeClosed:
+        raise HandshakeRefused('connection closed before any reply')
+    except socket.error, e:
+        if e.args[0] != errno.ECONNRESET:
+            raise
+        raise HandshakeRefused('connection reset before any reply')
+    frames = {}
+    while True:
+        ftype, length = struct.unpack('!BH', decrypt(first + recv_exact(sock, 3 - len(first))))
+        first = ''
+        if ftype == F_END:
+            return frames
+        frames[ftype] = decrypt(recv_exact(sock, length)) if length else ''
+
+
+def reject(status=STATUS_REJECTED):
+    return pack_frame(F_STATUS, chr(status)) + pack_frame(F_END, '')
+
+
+def parse_addr(data):
+    """ ATYP [len] addr port -> (addrtype, addr, port), HandshakeError if malformed """
+    if not data:
+        raise HandshakeError('bad address')
+    addrtype = ord(data[0])
+    if addrtype == 1:
+        if len(data) < 5:
+            raise HandshakeError('bad address')
+        addr, rest = socket.inet_ntoa(data[1:5]), data[5:]
+    elif addrtype == 4:
+        if len(data) < 17:
+            raise HandshakeError('bad address')
+        addr, rest = socket.inet_ntop(socket.AF_INET6, data[1:17]), data[17:]
+    elif addrtype == 3:
+        if len(data) < 2:
+            raise HandshakeError('bad address')
+        length = ord(data[1])
+        addr, rest = data[2:2+length], data[2+length:]
+    else:
+        raise HandshakeError('addr_type not support')
+    if len(rest) != 2:
+        raise HandshakeError('bad address')
+    return addrtype, addr, struct.unpack('>H', rest)[0]
+
+
+def deferred_address(addr_to_send, early_data='', owner=''):
+    """ What a deferred (warm) connection sends once it has a destination """
+    frames = pack_frame(F_ADDR, addr_to_send)
+    if owner:
+        frames += pack_frame(F_OWNER, owner)
+    if early_data:
+        frames += pack_frame(F_DATA, early_data[:MAX_FRAME])
+    return frames + pack_frame(F_END, '')
+
+
+def session_key(client_share, server_share):
+    return hashlib.md5(client_share + server_share).hexdigest()
+
+
+class ClientHandshake(object):
+
+    def __init__(self, rsa, ticket=None):
+        self.rsa = rsa
+        self.ticket = ticket            # (ticket, key) from an earlier session
+        self.id_seq = str(np.random.randint(0, 10000))
+        self.share = os.urandom(16)
+        self.resumed = False
+        self.new_ticket = None
+
+    def first_flight(self, addr_to_send, target=F_ADDR, owner=''):
+        """ target F_MUX or F_DEFER: no address now """
+        frames = [pack_frame(target, addr_to_send if target == F_ADDR else ''),
+                  pack_frame(F_PUBKEY, codec.pack_pubkey(self.rsa)),
+                  pack_frame(F_IDENT, codec.sign(self.rsa, self.id_seq + CLIENT_ID)),
+                  pack_frame(F_SHARE, self.share)]
+        if self.ticket:
+            ticket, key = self.ticket
+            frames.append(pack_frame(F_TICKET, ticket + binder(key, self.share)))
+        if owner and target == F_ADDR:
+            frames.append(pack_frame(F_OWNER, owner))
+        frames.append(pack_frame(F_END, ''))
+        return chr(HANDSHAKE_V2) + ''.join(frames)
+
+    def finish(self, frames):
+        """ Check the server's flight and return the session key """
+        status = ord(frames.get(F_STATUS) or chr(STATUS_REJECTED))
+        if status == STATUS_UNREACHABLE:
+            raise HandshakeError('server could not reach destination')
+        elif status == STATUS_BUSY:
+            raise ServerBusy('server busy')
+        elif status != STATUS_OK:
+            raise HandshakeError('server rejected handshake')
+        if F_RESUMED in frames and self.ticket:
+            self.resumed = True
+            return self.ticket[1]
+        try:
+            remote_pubkey = codec.unpack_pubkey(self.rsa, frames[F_PUBKEY])
+            id_data = codec.decrypt(self.rsa, frames[F_IDENT])
+            server_share = codec.verify(self.rsa, codec.decrypt(self.rsa, frames[F_SHARE]), remote_pubkey)
+        except (KeyError, ValueError), e:
+            raise HandshakeError('bad server flight: %s' % e)
+        if not id_data[:-10] == str(int(self.id_seq) + 1):
+            raise HandshakeError("Unknown seq")
+        if not id_data[-10:] == SERVER_ID:
+            raise HandshakeError("Unknown partner")
+        self.new_ticket = frames.get(F_TICKET)
+        return session_key(self.share, server_share)
+
+
+class ServerHandshake(object):
+
+    def __init__(self, frames, keys, tickets=None):
+        """ keys: KeyPool, only drawn from when the client can't resume """
+        self.target = F_MUX if F_MUX in frames else F_DEFER if F_DEFER in frames else F_ADDR
+        try:
+            self.addr = frames[F_ADDR] if self.target == F_ADDR else None
+            self.client_share = frames[F_SHARE]
+        except KeyError, e:
+            raise HandshakeError('bad client flight: %s' % e)
+        self.early_data = frames.get(F_DATA, '')
+        self.owner = frames.get(F_OWNER)
+        self.tickets = tickets
+        self.key = self._resume(frames.get(F_TICKET))
+        if self.key is None:
+            self._verify_client(frames, keys.get())
+
+    def _resume(self, data):
+        if not data or self.tickets is None:
+            return None
+        ticket, proof = data[:-BINDER_SIZE], data[-BINDER_SIZE:]
+        key = self.tickets.get(ticket)
+        if key is None or not hmac.compare_digest(proof, binder(key, self.client_share)):
+            return None
+        return key
+
+    def _verify_client(self, frames, rsa):
+        try:
+            self.remote_pubkey = codec.unpack_pubkey(rsa, frames[F_PUBKEY])
+            id_data = codec.verify(rsa, frames[F_IDENT], self.remote_pubkey)
+            self.id_seq = str(int(id_data[:-10]) + 1)
+        except (KeyError, ValueError), e:
+            raise HandshakeError('bad client flight: %s' % e)
+        if not id_data[-10:] == CLIENT_ID:
+            raise HandshakeError("Unknown partner")
+        self.rsa = rsa
+
+    @property
+    def resumed(self):
+        return self.key is not None
+
+    def reply(self, status=STATUS_OK):
+        """ Returns (reply flight, session key) """
+        if status != STATUS_OK:
+            return reject(status), None
+        if self.resumed:
+            return pack_frame(F_STATUS, '\x00') + pack_frame(F_RESUMED, '') + pack_frame(F_END, ''), self.key
+        share = os.urandom(16)
+        key = session_key(self.client_share, share)
+        frames = [pack_frame(F_STATUS, '\x00'),
+                  pack_frame(F_PUBKEY, codec.pack_pubkey(self.rsa)),
+                  pack_frame(F_IDENT, codec.encrypt(self.rsa, self.id_seq + SERVER_ID, self.remote_pubkey)),
+                  pack_frame(F_SHARE, codec.encrypt(self.rsa, codec.sign(self.rsa, share), self.remote_pubkey))]
+        if self.tickets is not None:
+            frames.append(pack_frame(F_TICKET, self.tickets.issue(key)))
+        frames.append(pack_frame(F_END, ''))
+        return ''.join(frames), key
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+import gevent
+from gevent.os import make_nonblocking, nb_read, nb_write
+import numpy as np
+from rsa import RSA
+
+
+def generate_keypair(k=20):
+    rsa = RSA(k=k)
+    return rsa.p, rsa.q, rsa.e
+
+
+class KeyPool(object):
+    """
+    Pre-generated RSA keypairs. A producer (forked process or greenlet) refills
+    the pool up to `size` whenever it drops to `low`; get() falls back to
+    generating inline when the pool is empty.
+    """
+
+    def __init__(self, size=8, low=2, mode='process', k=20):
+        self.size = size
+        self.low = min(low, size)
+        self.mode = mode
+        self.k = k
+        self.keys = []
+        self.pending = 0                # requested from the producer, not yet received
+        self.refill = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+
+    def start(self):
+        if self.size <= 0:
+            return self
+        if self.mode == 'process':
+            self._spawn()
+        else:
+            gevent.spawn(self._produce_inline)
+        self._request()
+        return self
+
+    def get(self):
+        if self.keys:
+            p, q, e = self.keys.pop()
+            self.hits += 1
+            rsa = RSA(p=p, q=q, e=e, k=self.k)
+        else:
+            self.misses += 1
+            logging.warn("key pool empty, generating keypair inline")
+            rsa = RSA(k=self.k)
+        if len(self.keys) + self.pending <= self.low:
+            self._request()
+        return rsa
+
+    def stats(self):
+        return {'ready': len(self.keys), 'pending': self.pending, 'hits': self.hits, 'misses': self.misses}
+
+    def _request(self):
+        n = min(self.size - len(self.keys) - self.pending, 255)
+        if n <= 0:
+            return
+        self.pending += n
+        if self.mode == 'process':
+            try:
+                nb_write(self.request_fd, chr(n))
+            except OSError, e:
+                logging.warn("key producer gone: %s" % e)
+                self.pending = 0
+        else:
+            self.refill.set()
+
+    def _add(self, key):
+        self.pending = max(self.pending - 1, 0)
+        if len(self.keys) < self.size:
+            self.keys.append(key)
+
+    def _produce_inline(self):
+        while True:
+            self.refill.wait()
+            self.refill.clear()
+            while self.pending > 0:
+                self._add(generate_keypair(self.k))
+                gevent.sleep(0)
+
+    def _spawn(self):
+        request_r, request_w = os.pipe()
+        key_r, key_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(request_w)
+            os.close(key_r)
+            try:
+                _producer(request_r, key_w, self.k)
+            finally:
+                os._exit(0)
+        os.close(request_r)
+        os.close(key_w)
+        make_nonblocking(request_w)
+        make_nonblocking(key_r)
+        self.pid = pid
+        self.request_fd = request_w
+        gevent.spawn(self._receive, key_r)
+
+    def _receive(self, fd):
+        buf = ''
+        while True:
+            data = nb_read(fd, 4096)
+            if not data:
+                break
+            buf += data
+            while '\n' in buf:
+                line, buf = buf.split('\n', 1)
+                self._add(tuple(int(v) for v in line.split()))
+        logging.warn("key producer %d exited, respawning" % self.pid)
+        os.close(fd)
+        os.close(self.request_fd)
+        os.waitpid(self.pid, 0)
+        self.pending = 0
+        self._spawn()
+        self._request()
+
+
+def _producer(request_fd, key_fd, k):
+    # child process: plain blocking io, no gevent
+    np.random.seed()
+    while True:
+        n = os.read(request_fd, 1)
+        if not n:
+            return
+        for i in xrange(ord(n)):
+            os.write(key_fd, '%d %d %d\n' % generate_keypair(k))
+
+
+def start_key_pool(config):
+    return KeyPool(config.get('key_pool_size', 8), config.get('key_pool_low', 2),
+                   config.get('key_pool_mode', 'process')).start()
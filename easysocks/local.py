@@ -7,29 +7,39 @@ import SocketServer
 import struct
 import string
 import hashlib
+import hmac
 import os
+import time
 import json
 import logging
 import getopt
 SOCKS_VERSION=5
-from pyDes import des, PAD_PKCS5, ECB
-from rsa import RSA
+from rsa import CODECS
+from table import load_tables
+from cipher import load_cipher
+from keypool import start_key_pool
+from primes import load_primes
+from ticket import load_tickets
+from handshake import (ClientHandshake, HandshakeError, HandshakeClosed, HandshakeRefused, ServerBusy, read_frames,
+                       deferred_address, F_ADDR, F_MUX, F_DEFER, MAX_FRAME)
+from warmpool import WarmPool
+from mux import MuxClient, MuxSession, pipe
+from relay import load_relay, log_closed, RelayServerMixin
+from timerwheel import load_timeouts
+from workers import supervise, bind_server
+from balancer import load_balancer
+from stats import Metrics, StatsServer, count_tunnel
+from socks5 import Socks5Parser, read_message
+from auth import load_credentials
+from shaping import load_shaper
+from admission import AdmissionServerMixin, load_admission
 import numpy as np
 
-def get_table(key):
-    m = hashlib.md5()
-    m.update(key)
-    s = m.digest()
-    (a, b) = struct.unpack('<QQ', s)
-    table = [c for c in string.maketrans('', '')]
-    for i in xrange(1, 1024):
-        table.sort(lambda x, y: int(a % (ord(x) + i) - a % (ord(y) + i)))
-    return table
-
 def send_all(sock, data):
+    view = memoryview(data)             # partial sends must not copy the rest
     bytes_sent = 0
     while True:
-        r = sock.send(data[bytes_sent:])
+        r = sock.send(view[bytes_sent:])
         if r < 0:
             return r
         bytes_sent += r
@@ -37,73 +47,196 @@ def send_all(sock, data):
             return bytes_sent
 
 
-def find_random_prime(lower_bound=1, upper_bound=20, seed=0):
-    assert (lower_bound >= 1), "Lower_bound must be no less than 1."
-    np.random.seed(seed=seed)
-    index = np.random.randint(lower_bound, upper_bound)
+def connect_remote(upstream):
+    if '-6' in sys.argv[1:]:                # IPv6 support
+        remote = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    remote.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)       # turn off Nagling
+    remote.settimeout(timeouts.connect)
+    try:
+        remote.connect(upstream.address)
+    except socket.timeout:
+        timeouts.fired('connect')
+        remote.close()
+        raise socket.error('connect to %s timed out' % upstream)
+    except socket.error:
+        remote.close()
+        raise
+    remote.settimeout(timeouts.handshake)
+    return remote
+
+
+def owner_tag(user):
+    """ What the server keys origin connection reuse by for user; not the name itself """
+    return hmac.new(OWNER_SECRET, str(user), hashlib.sha256).digest()[:16]
+
+
+def client_handshake(remote, upstream, addr_to_send, target=F_ADDR, owner=''):
+    """ Handshake v2 on a fresh server connection, resuming when we hold a ticket: (key, nonce) """
+    server = upstream.address
+    ticket = tickets.get(server)
+    hs = ClientHandshake(keys.get(), ticket)
+    send_all(remote, hs.first_flight(addr_to_send, target, owner).translate(encrypt_table))
+    DES_KEY = hs.finish(read_frames(remote, lambda data: data.translate(decrypt_table)))
+    if ticket:
+        tickets.record(server, hs.resumed)
+    if hs.new_ticket:
+        tickets.put(server, (hs.new_ticket, DES_KEY))
+    if hs.resumed:
+        logging.info("Client resumed session with %s (%d/%d tickets accepted)"
+                     % (upstream, tickets.resumed, tickets.resumed + tickets.rejected))
+    else:
+        logging.info("Client handshake v2 with %s complete with key %s" % (upstream, DES_KEY))
+    return DES_KEY, hs.share
+
+
+def is_legacy(address):
+    """ Whether address fell back to handshake v1 recently; once that expires, v2 is tried again """
+    until = legacy_servers.get(address)
+    if until is None:
+        return False
+    if until < time.time():
+        legacy_servers.pop(address, None)
+        return False
+    return True
 
-    prime_list = []
-    
-    i = 2
-    while(True):
-        if (len(prime_list) >= index):
-            break
-        if gmpy.is_prime(i):
-            prime_list.append(i)
-        i += 1
 
-    return prime_list[index-1]
+def mark_legacy(upstream, e):
+    logging.warn("server %s does not speak handshake v2 (%s), falling back" % (upstream, e))
+    legacy_servers[upstream.address] = time.time() + LEGACY_RETRY
 
 
-class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):   # Multiple inheritance
+def connect_upstream(exclude=()):
+    """ (remote, upstream, start) to the balancer's pick, moving on to the others while connects fail """
+    tried = set(exclude)
+    while True:
+        upstream = balancer.pick(tried)
+        balancer.begin(upstream)
+        start = time.time()
+        try:
+            return connect_remote(upstream), upstream, start
+        except socket.error:
+            balancer.failed(upstream)
+            tried.add(upstream)
+            if len(tried) >= len(balancer.upstreams):
+                raise
+
+
+def handshake_failed(upstream, e):
+    """
+    Transport errors count against the server, and so does a busy one: it is
+    shedding load, so traffic should go elsewhere. A reply that turns down
+    just this tunnel does not.
+    """
+    if isinstance(e, HandshakeRefused):
+        mark_legacy(upstream, e)        # up, but only through the v1 fallback
+        balancer.declined(upstream)
+    elif isinstance(e, (socket.error, HandshakeClosed, ServerBusy)):
+        balancer.failed(upstream)
+    else:
+        balancer.declined(upstream)
+
+
+def busy_retry(upstream, busy):
+    """ After a ServerBusy from upstream: whether another server is left to try """
+    busy.add(upstream)
+    if len(busy) >= len(balancer.upstreams):
+        return False
+    logging.info("server %s busy, trying another" % upstream)
+    return True
+
+
+def open_upstream(target):
+    """ (remote, (key, nonce), upstream): a keyed connection for target, from a server that speaks v2 """
+    busy = set()
+    while True:
+        remote, upstream, start = connect_upstream(busy | set(u for u in balancer.upstreams if is_legacy(u.address)))
+        try:
+            keying = client_handshake(remote, upstream, None, target=target)
+        except ServerBusy, e:
+            handshake_failed(upstream, e)
+            remote.close()
+            if busy_retry(upstream, busy):
+                continue
+            raise
+        except Exception, e:
+            handshake_failed(upstream, e)
+            remote.close()
+            raise
+        balancer.succeeded(upstream, time.time() - start)
+        return remote, keying, upstream
+
+
+def open_mux_session():
+    remote, keying, upstream = open_upstream(F_MUX)
+    encrypt, decrypt = ciphers.session(*keying)
+    remote.settimeout(timeouts.idle)
+    return MuxSession(remote, encrypt, decrypt, MUX_WINDOW)
+
+
+def open_warm_connection():
+    """ None while every server is taken for a v1 one: those have nothing to defer to """
+    if all(is_legacy(u.address) for u in balancer.upstreams):
+        return None
+    return open_upstream(F_DEFER)
+
+
+def record_setup(upstream, phases, cipher):
+    """ phases: (connect, key exchange) seconds, None for a warm connection keyed in advance """
+    if phases is None:
+        logging.info("tunnel setup via %s: warm connection, cipher %.2f ms" % (upstream, cipher * 1000))
+        metrics.count('warm_tunnels')
+    else:
+        logging.info("tunnel setup via %s: connect %.2f ms, key exchange %.2f ms, cipher %.2f ms"
+                     % (upstream, phases[0] * 1000, phases[1] * 1000, cipher * 1000))
+        metrics.observe('connect_ms', phases[0] * 1000)
+        metrics.observe('key_exchange_ms', phases[1] * 1000)
+    metrics.observe('cipher_ms', cipher * 1000)
+
+
+def tunnel_closed(tunnel, upstream, slot):
+    slot.release()
+    log_closed(tunnel)
+    balancer.closed(upstream)
+    count_tunnel(metrics, tunnel)
+
+
+class ThreadingTCPServer(AdmissionServerMixin, RelayServerMixin, SocketServer.ThreadingMixIn, SocketServer.TCPServer):   # Multiple inheritance
    allow_reuse_address = True
+   request_queue_size = 128         # "accept_backlog"
+   reject_reply = "\x05\xff"        # over capacity: SOCKS5 "no acceptable methods", before the greeting is read
 
 
 class Socks5Server(SocketServer.StreamRequestHandler):
     # TODO
-    username = "username"
+    username = "username"   # the only user unless config.json has a users_file
     password = "password"
     exchanged = False
+    pipelined = ''      # bytes the client sent right behind its CONNECT request
+    user = None         # SOCKS5 username, for shaping and accounting
     
-    def handle_tcp(self, sock, remote):
-        try:
-            fdset = [sock, remote]
-            while True:
-                r, w, e = select.select(fdset, [], []) 
-                if sock in r:                               # if local socket is ready for reading
-                    data = sock.recv(4096)
-                    data = self.DES_encrypt(data)
-                    if len(data) <= 0:                      # received all data
-                        break
-                    result = send_all(remote, data)   # send data after encrypting
-                    if result < len(data):
-                        raise Exception('failed to send all data')
-
-                if remote in r:                             # remote socket(proxy) ready for reading
-                    data = remote.recv(4096)
-                    data = self.DES_decrypt(data)
-                    if len(data) <= 0:
-                        break
-                    result = send_all(sock, data)     # send to local socket(application)
-                    if result < len(data):
-                        raise Exception('failed to send all data')
-        finally:
-            logging.info("Finishing close tcp")
-            sock.close()
-            remote.close()
+    def handle_tcp(self, sock, remote, upstream):
+        """ Hand the tunnel to the relay engine, it outlives this handler """
+        self.server.detach(self.request)
+        slot = self.server.slot(self.request)
+        slot.established(detached=True)
+        balancer.opened(upstream)
+        relay.add(sock, remote, self.encryptor, self.decryptor,
+                  lambda tunnel: tunnel_closed(tunnel, upstream, slot), shape=shaper.paths(self.user))
     
-    def exchange_key(self, sock, remote):
-        self.rsa = RSA()
+    def exchange_key(self, sock, remote, codec):
+        self.rsa = keys.get()
         try:
             # 1. send public key
             print("RSA KEY", self.rsa.e, self.rsa.n)
-            pub_key = (self.rsa.get_stringfied(self.rsa.e) + '-' + self.rsa.get_stringfied(self.rsa.n)).encode('utf-8')
+            pub_key = codec.pack_pubkey(self.rsa)
 
             result = send_all(remote, self.encrypt(pub_key))
             
             # 2. receive public key
             remote_pubkey = self.decrypt(remote.recv(4096))
-            self.remote_pubkey = [self.rsa.unstringfied(k) for k in remote_pubkey.decode('utf-8').strip().split('-')]
+            self.remote_pubkey = codec.unpack_pubkey(self.rsa, remote_pubkey)
             logging.info("Local receive pubkey: %s" % self.remote_pubkey)
 
             # 3. identification check
@@ -112,11 +245,10 @@ class Socks5Server(SocketServer.StreamRequestHandler):
 
             logging.info("Client send id_data: %s" % id_seq+id_msg)
             
-            id_data = self.rsa._encode(id_seq+id_msg, self.remote_pubkey[0], self.remote_pubkey[1], self.rsa.k)
+            id_data = codec.encrypt(self.rsa, id_seq+id_msg, self.remote_pubkey)
             result = send_all(remote, id_data)
 
-            id_data = remote.recv(4096).decode('utf-8')
-            id_data = self.rsa._decode(id_data, self.rsa.d, self.rsa.n, self.rsa.k)
+            id_data = codec.decrypt(self.rsa, remote.recv(4096))
             id_data = id_data.strip()
             if not id_data[:-10] == str(int(id_seq)+1):
                 raise Exception("Unknown seq")
@@ -128,9 +260,9 @@ class Socks5Server(SocketServer.StreamRequestHandler):
 
             __DES_KEY = DES_KEY
             ## encrypt by private A
-            DES_KEY = self.rsa._encode(DES_KEY, self.rsa.d, self.rsa.n, self.rsa.k)
+            DES_KEY = codec.sign(self.rsa, DES_KEY)
             ## encrypt by public B
-            DES_KEY = self.rsa._encode(DES_KEY, self.remote_pubkey[0], self.remote_pubkey[1], self.rsa.k).encode('utf-8')
+            DES_KEY = codec.encrypt(self.rsa, DES_KEY, self.remote_pubkey)
 
             result = send_all(remote, DES_KEY)
             logging.info("Client exchange complete with DES key %s" % __DES_KEY)
@@ -145,6 +277,61 @@ class Socks5Server(SocketServer.StreamRequestHandler):
             # For safety
             return "12345678"
 
+    def legacy_codec(self, upstream):
+        # a server that predates handshake v2 may predate the block codec too
+        if is_legacy(upstream.address):
+            return CODECS['legacy']
+        return CODEC
+
+    def handshake(self, sock, remote, upstream, addr_to_send):
+        """
+        Single flight key exchange (handshake v2). Servers that only speak the
+        legacy protocol hang up on the first byte, before replying; remember
+        them for legacy_retry seconds and redo the connection with exchange_key.
+        Timeouts and other errors are not taken for that. Returns ((key, nonce),
+        remote, data still to send). Application data never rides in the first
+        flight, which only the password table covers: it goes after keying.
+        """
+        try:
+            keying = client_handshake(remote, upstream, addr_to_send, F_ADDR, owner_tag(self.user))
+            return keying, remote, self.pipelined
+        except HandshakeRefused, e:
+            mark_legacy(upstream, e)
+            remote.close()
+            remote = connect_remote(upstream)
+            self.send_encrypt(remote, addr_to_send)
+            return (self.exchange_key(sock, remote, self.legacy_codec(upstream)), ''), remote, self.pipelined
+        except (HandshakeError, socket.error):
+            remote.close()
+            raise
+
+    def open_tunnel(self, sock, addr_to_send):
+        """
+        Connect to the balancer's pick and key the tunnel:
+        ((key, nonce), remote, data still to send, upstream, (connect, key exchange seconds))
+        """
+        busy = set()
+        while True:
+            remote, upstream, start = connect_upstream(busy)
+            connected = time.time()
+            try:
+                if HANDSHAKE_VERSION >= 2 and not is_legacy(upstream.address):
+                    keying, remote, pending = self.handshake(sock, remote, upstream, addr_to_send)
+                else:
+                    self.send_encrypt(remote, addr_to_send)      # encrypted
+                    keying, pending = (self.exchange_key(sock, remote, self.legacy_codec(upstream)), ''), self.pipelined
+            except ServerBusy, e:
+                handshake_failed(upstream, e)
+                if busy_retry(upstream, busy):
+                    continue
+                raise
+            except Exception, e:
+                handshake_failed(upstream, e)
+                raise
+            done = time.time()
+            balancer.succeeded(upstream, done - start)
+            return keying, remote, pending, upstream, (connected - start, done - connected)
+
     def encrypt(self, data):
         return data.translate(encrypt_table)
 
@@ -152,31 +339,18 @@ class Socks5Server(SocketServer.StreamRequestHandler):
         return data.translate(decrypt_table)
     
     def DES_encrypt(self, data):
-        return data.translate(self.new_encrypt_table)
+        return self.encryptor.process(data)
     
     def DES_decrypt(self, data):
-        return data.translate(self.new_decrypt_table)
+        return self.decryptor.process(data)
 
     def send_encrypt(self, sock, data):
         sock.send(self.encrypt(data))
 
-    def get_available_methods(self, n):
-        methods = []
-        for i in range(n):
-            methods.append(ord(self.connection.recv(1)))
-        return methods
-
-    def verify_credentials(self):
-        version = ord(self.connection.recv(1))
-        assert version == 1
-
-        username_len = ord(self.connection.recv(1))
-        username = self.connection.recv(username_len).decode('utf-8')
-
-        password_len = ord(self.connection.recv(1))
-        password = self.connection.recv(password_len).decode('utf-8')
-
-        if username == self.username and password == self.password:
+    def verify_credentials(self, auth):
+        version = 1
+        if credentials.verify(auth.username, auth.password):
+            self.user = auth.username
             # success, status = 0
             response = struct.pack("!BB", version, 0)
             send_all(self.connection, response)
@@ -191,78 +365,74 @@ class Socks5Server(SocketServer.StreamRequestHandler):
     def handle(self):
         try:
 #            logging.info('Accepting connection from %s:%s' % self.client_address)
-            header = self.connection.recv(2)
-            version, nmethods = struct.unpack("!BB", header)
-            assert version == SOCKS_VERSION
-            assert nmethods > 0
-#
-        # get available methods
-            methods = self.get_available_methods(nmethods)
-
-#            sock.recv(262)                # Sock5 Verification packet
-            if 2 not in set(methods):
+            self.connection.settimeout(timeouts.handshake)
+            start = time.time()
+            sock = self.connection        # local socket [127.1:port]
+            parser = Socks5Parser()       # greeting, auth and request may arrive in one segment
+            greeting = read_message(sock, parser)
+            start = metrics.time('methods_ms', start)
+
+            if 2 not in greeting.methods:
                 self.server.close_request(self.request)
                 return
-            sock = self.connection        # local socket [127.1:port]
-            sock.send("\x05\x02")         # Sock5 Response: '0x05' Version 5; '0x00' NO AUTHENTICATION REQUIRED
+            sock.send("\x05\x02")         # Sock5 Response: '0x05' Version 5; '0x02' USERNAME/PASSWORD
             # After Authentication negotiation
-            if not self.verify_credentials():
+            if not self.verify_credentials(read_message(sock, parser)):
+                metrics.count('auth_failures')
                 logging.warn("credential fail")
                 return
-            data = self.rfile.read(4)     # Forward request format: VER CMD RSV ATYP (4 bytes)
+            start = metrics.time('auth_ms', start)
+            request = read_message(sock, parser)      # VER CMD RSV ATYP [len] dst addr port
             # CMD == 0x01 (connect)
-            mode = ord(data[1])           
-            logging.info('mode=' + str(mode))
-            if mode != 1:
+            logging.info('mode=' + str(request.cmd))
+            if request.cmd != 1:
                 logging.warn('mode != 1')
                 return
-            # dst addr
-            addrtype = ord(data[3])       # indicate destination address type
-            addr_to_send = data[3]
-            if addrtype == 1 :             # IPv4
-                addr_ip = self.rfile.read(4)            # 4 bytes IPv4 address (big endian)
-                addr = socket.inet_ntoa(addr_ip)
-                addr_to_send += addr_ip
-            elif addrtype == 3:           # FQDN (Fully Qualified Domain Name)
-                addr_len = self.rfile.read(1)           # Domain name's Length
-                addr = self.rfile.read(ord(addr_len))   # Followed by domain name(e.g. www.google.com)
-                addr_to_send += addr_len + addr
-            elif addrtype ==4:
-                addr_ip = self.rfile.read(16)
-                addr = socket.inet_ntop(socket.AF_INET6, addr_ip)
-                addr_to_send += addr_ip
-            else:
-                logging.warn('addr_type notsupport')
-                # not support
-                return
-
-            addr_port = self.rfile.read(2)
-            addr_to_send += addr_port                   # addr_to_send = ATYP + [Length] + dst addr/domain name + port
-            port = struct.unpack('>H', addr_port)       # prase the big endian port number. Note: The result is a tuple even if it contains exactly one item.
+            addr, port = request.host, request.port
+            addr_to_send = request.addr                 # addr_to_send = ATYP + [Length] + dst addr/domain name + port
+            self.pipelined = parser.rest()              # application data sent along with the request
+            metrics.time('address_ms', start)
             try:
                 reply = "\x05\x00\x00\x01"              # VER REP RSV ATYP
                 reply += socket.inet_aton('0.0.0.0') + struct.pack(">H", 2222)  # listening on 2222 on all addresses of the machine, including the loopback(127.0.0.1)
-                self.wfile.write(reply)                 # response packet
+                send_all(sock, reply)                   # response packet
                 # reply immediately
-                if '-6' in sys.argv[1:]:                # IPv6 support
-                    remote = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                else:
-                    remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)       # turn off Nagling
-                remote.connect((SERVER, REMOTE_PORT))
-                
-                self.send_encrypt(remote, addr_to_send)      # encrypted
-                logging.info('connecting %s:%d' % (addr, port[0]))
+                logging.info('connecting %s:%d' % (addr, port))
+                if mux:
+                    sock.settimeout(None)               # pipe() times out the whole stream instead
+                    stream = mux.open(addr_to_send)
+                    self.server.slot(self.request).established()
+                    if self.pipelined:
+                        stream.send(self.pipelined)
+                    if pipe(sock, stream, timeouts.idle):
+                        timeouts.fired('idle')
+                    return
+                warm_conn = warm.get() if warm else None
             except socket.error, e:
                 logging.warn(e)
                 return
 
-            # Only exchange key for the first time.
-            DES_KEY = self.exchange_key(sock, remote)
-            self.new_encrypt_table = ''.join(get_table(DES_KEY))
-            self.new_decrypt_table = string.maketrans(self.new_encrypt_table, string.maketrans('', ''))
-            
-            self.handle_tcp(sock, remote)
+            if warm_conn:
+                remote, keying, upstream = warm_conn
+                phases = None
+            else:
+                keying, remote, pending, upstream, phases = self.open_tunnel(sock, addr_to_send)
+            start = time.time()
+            self.encryptor, self.decryptor = ciphers.session(*keying)
+            record_setup(upstream, phases, time.time() - start)
+            if warm_conn:
+                # already under the session key: pipelined bytes may ride along with the address
+                early_data, pending = self.pipelined[:MAX_FRAME], self.pipelined[MAX_FRAME:]
+                send_all(remote, self.DES_encrypt(deferred_address(addr_to_send, early_data, owner_tag(self.user))))
+            if pending:
+                send_all(remote, self.DES_encrypt(pending))
+
+            self.handle_tcp(sock, remote, upstream)
+        except HandshakeError, e:
+            logging.warn(e)
+        except socket.timeout, e:
+            timeouts.fired('handshake')
+            logging.warn("handshake timed out")
         except socket.error, e:
             logging.warn(e)
 
@@ -271,37 +441,89 @@ def readConfig():
         config = json.load(f)
     SERVER = config['server']
     REMOTE_PORT = config['server_port']
+    SERVERS = config.get('servers') or [[SERVER, REMOTE_PORT]]     # [[host, port], ...]
     PORT = config['local_port']
     KEY = config['password']
 
-    optlist, args = getopt.getopt(sys.argv[1:], 's:p:k:l:')
+    optlist, args = getopt.getopt(sys.argv[1:], 's:p:k:l:', ['workers=', 'cipher='])
     for key, value in optlist:
         if key == '-p':
             REMOTE_PORT = int(value)
+            SERVERS = [[SERVER, REMOTE_PORT]]
         elif key == '-k':
             KEY = value
         elif key == '-l':
             PORT = int(value)
         elif key == '-s':
             SERVER = value
+            SERVERS = [[SERVER, REMOTE_PORT]]
+        elif key == '--workers':
+            config['workers'] = int(value)
+        elif key == '--cipher':
+            config['cipher'] = value
 
-    return SERVER, REMOTE_PORT, PORT, KEY 
+    return SERVERS, PORT, KEY, config
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(__file__) or '.')
     print 'naivesocks v0.1'
 
-    SERVER, REMOTE_PORT, PORT, KEY = readConfig()
+    SERVERS, PORT, KEY, config = readConfig()
+    ThreadingTCPServer.request_queue_size = config.get('accept_backlog', 128)
 
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S', filemode='a+')
 
-    encrypt_table = ''.join(get_table(KEY))
-    decrypt_table = string.maketrans(encrypt_table, string.maketrans('', ''))
+    try:
+        # each worker builds its own caches below, after the fork
+        listen = lambda reuse_port=False: bind_server(ThreadingTCPServer, ('', PORT), Socks5Server, reuse_port)
+        server, reporter = supervise(config.get('workers', 1), listen, config,
+                                     config.get('local_stats_port', 0), 'easysocks_local')
+    except socket.error, e:
+        logging.error(e)
+        sys.exit(1)
+
+    tables = load_tables(config)
+    encrypt_table, decrypt_table = tables.get(KEY)
+    ciphers = load_cipher(config, tables)
+    load_primes(config)
+    keys = start_key_pool(config)
+    CODEC = CODECS[config.get('rsa_codec', 'block')]
+    HANDSHAKE_VERSION = config.get('handshake', 2)
+    OWNER_SECRET = os.urandom(16)
+    legacy_servers = {}         # address -> until when it is taken for a v1 server
+    LEGACY_RETRY = config.get('legacy_retry', 600)
+    tickets = load_tickets(config)
+    relay = load_relay(config)
+    timeouts = load_timeouts(config)
+    balancer = load_balancer(config, SERVERS)
+    metrics = Metrics()
+    credentials = load_credentials(config, Socks5Server.username, Socks5Server.password)
+    shaper = load_shaper(config)
+    admission = load_admission(config)
+    MUX_WINDOW = config.get('mux_window', 256 * 1024)
+    mux = None
+    if config.get('mux_tunnels', 0) > 0:
+        mux = MuxClient(open_mux_session, config['mux_tunnels'])
+    warm = None
+    if config.get('warm_pool_max', 0) > 0 and HANDSHAKE_VERSION >= 2:
+        warm = WarmPool(open_warm_connection, config.get('warm_pool_min', 2), config['warm_pool_max'],
+                        config.get('warm_pool_idle', 60), config.get('warm_pool_interval', 5),
+                        config.get('warm_pool_backoff', 300)).start()
 
     try:
-        server = ThreadingTCPServer(('', PORT), Socks5Server)
-        logging.info("starting server at port %d ..." % PORT)
+        server = server or listen()
+        server.admission = admission
+        collect = lambda: {'relay': relay.stats(), 'tables': tables.stats(), 'keys': keys.stats(),
+                           'tickets': tickets.stats(), 'warm': warm.stats() if warm else {},
+                           'timeouts': timeouts.stats(), 'upstreams': balancer.stats(), 'stages': metrics.stats(),
+                           'auth': credentials.stats(), 'shaping': shaper.stats(),
+                           'admission': admission.stats() if admission else {}}
+        if reporter:
+            reporter.start(collect)
+        elif config.get('local_stats_port'):
+            StatsServer(config['local_stats_port'], collect, 'easysocks_local').start()
+        logging.info("starting server at port %d (pid %d) ..." % (PORT, os.getpid()))
         server.serve_forever()
     except socket.error, e:
         logging.error(e)
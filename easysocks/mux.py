@@ -0,0 +1,236 @@
+import time
+import socket
+import struct
+import logging
+import threading
+import gevent
+from gevent.queue import Queue
+from gevent.event import Event, AsyncResult
+from handshake import recv_exact, HandshakeError
+
+# Frames on a keyed tunnel, after the v2 handshake (F_MUX instead of F_ADDR):
+#
+#   stream id (4) | type (1) | length (2) | payload
+#
+# The client opens odd stream ids. OPEN carries the same address bytes as the
+# handshake's F_ADDR. Each side may have at most the peer's `window` of
+# unacknowledged DATA bytes in flight per stream; the receiver returns credit
+# with WINDOW once its socket has taken half of its own window. CLOSE ends
+# the stream in both directions.
+#
+# Both sides announce their window first thing, as a WINDOW frame on stream
+# 0. Until the peer's arrives a side assumes its own; streams opened before
+# then get the difference once it does, which may leave them owing credit
+# (a negative window) until enough WINDOW frames come back. Peers that do
+# not announce ignore the frame and are taken to use the same window.
+HEADER = struct.Struct('!IBH')
+OPEN, OPENED, DATA, CLOSE, WINDOW = range(1, 6)
+MAX_PAYLOAD = 16384
+DEFAULT_WINDOW = 256 * 1024
+
+
+class MuxStream(object):
+
+    def __init__(self, session, stream_id):
+        self.session = session
+        self.id = stream_id
+        self.send_window = session.peer_window
+        self.window_open = Event()
+        self.window_open.set()
+        self.unacked = 0
+        self.queue = Queue()
+        self.opened = AsyncResult()
+        self.closed = False
+        self.active = time.time()       # last DATA either way
+
+    def send(self, data):
+        while data:
+            while self.send_window <= 0 and not self.closed:
+                self.window_open.clear()
+                self.window_open.wait()
+            if self.closed:
+                raise socket.error('mux stream %d closed' % self.id)
+            n = min(len(data), self.send_window, MAX_PAYLOAD)
+            self.send_window -= n
+            self.active = time.time()
+            self.session.send_frame(self.id, DATA, data[:n])
+            data = data[n:]
+
+    def recv(self):
+        """ Next chunk of data, None once the stream is closed """
+        return self.queue.get()
+
+    def consumed(self, n):
+        self.unacked += n
+        if self.unacked >= self.session.window // 2 and not self.closed:
+            self.session.send_frame(self.id, WINDOW, struct.pack('!I', self.unacked))
+            self.unacked = 0
+
+    def reply(self, status):
+        """ Server: report whether the destination connect worked """
+        self.session.send_frame(self.id, OPENED, chr(status))
+        if status:
+            self._closed()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.session.send_frame(self.id, CLOSE, '')
+            except socket.error:
+                pass
+        self._closed()
+
+    def _closed(self):
+        self.closed = True
+        self.session.streams.pop(self.id, None)
+        if not self.opened.ready():
+            self.opened.set(1)
+        self.queue.put(None)
+        self.window_open.set()
+
+
+class MuxSession(object):
+
+    def __init__(self, sock, encrypt, decrypt, window=DEFAULT_WINDOW, on_open=None):
+        self.sock = sock
+        self.encrypt = encrypt          # cipher.py streams
+        self.decrypt = decrypt
+        self.window = window            # what we take per stream before returning credit
+        self.peer_window = window       # what the peer takes, once it has said so
+        self.on_open = on_open          # server: on_open(stream, addr_to_send)
+        self.streams = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.alive = True
+        self.send_frame(0, WINDOW, struct.pack('!I', window))   # ahead of any OPEN
+
+    def send_frame(self, stream_id, ftype, payload):
+        frame = HEADER.pack(stream_id, ftype, len(payload)) + payload
+        with self.lock:                 # a keystream must see frames in the order they are sent
+            self.sock.sendall(self.encrypt.process(frame))
+
+    def open(self, addr_to_send):
+        """ Client: start a stream; data may follow before the server has connected """
+        if not self.alive:
+            raise socket.error('mux session closed')
+        stream = MuxStream(self, self.next_id)
+        self.next_id += 2
+        self.streams[stream.id] = stream
+        self.send_frame(stream.id, OPEN, addr_to_send)
+        return stream
+
+    def run(self):
+        try:
+            while True:
+                header = self.decrypt.process(recv_exact(self.sock, HEADER.size))
+                stream_id, ftype, length = HEADER.unpack(header)
+                payload = self.decrypt.process(recv_exact(self.sock, length)) if length else ''
+                self.dispatch(stream_id, ftype, payload)
+        except (HandshakeError, socket.error), e:
+            logging.info("mux session closed: %s" % e)
+        finally:
+            self.alive = False
+            for stream in self.streams.values():
+                stream._closed()
+            self.sock.close()
+
+    def dispatch(self, stream_id, ftype, payload):
+        if ftype == OPEN and self.on_open:
+            stream = self.streams[stream_id] = MuxStream(self, stream_id)
+            gevent.spawn(self.on_open, stream, payload)
+            return
+        if ftype == WINDOW and not stream_id:
+            window = struct.unpack('!I', payload)[0]
+            for stream in self.streams.values():
+                stream.send_window += window - self.peer_window
+                stream.window_open.set()
+            self.peer_window = window
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:                  # frames racing a CLOSE
+            return
+        if ftype == DATA:
+            stream.active = time.time()
+            stream.queue.put(payload)
+        elif ftype == WINDOW:
+            stream.send_window += struct.unpack('!I', payload)[0]
+            stream.window_open.set()
+        elif ftype == OPENED:
+            stream.opened.set(ord(payload))
+            if ord(payload):
+                stream._closed()
+        elif ftype == CLOSE:
+            stream._closed()
+
+
+class MuxClient(object):
+    """ Up to `tunnels` keyed sessions; new streams go to the least loaded one """
+
+    def __init__(self, connect, tunnels=1):
+        self.connect = connect          # () -> MuxSession
+        self.tunnels = tunnels
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def session(self):
+        with self.lock:
+            self.sessions = [s for s in self.sessions if s.alive]
+            if len(self.sessions) < self.tunnels:
+                session = self.connect()
+                gevent.spawn(session.run)
+                self.sessions.append(session)
+                return session
+            return min(self.sessions, key=lambda s: len(s.streams))
+
+    def open(self, addr_to_send):
+        return self.session().open(addr_to_send)
+
+
+def pipe(sock, stream, idle=None):
+    """
+    Relay between a socket and a mux stream until either side closes, or
+    until neither direction has carried data for idle seconds: True then.
+    sock should have no timeout of its own, which would time out each
+    direction alone.
+    """
+    expired = []
+
+    def watch():
+        while not stream.closed:
+            left = stream.active + idle - time.time()
+            if left <= 0:
+                expired.append(stream.id)
+                stream.close()
+                return
+            gevent.sleep(left)
+
+    def upstream():
+        try:
+            while True:
+                data = sock.recv(MAX_PAYLOAD)
+                if not data:
+                    break
+                stream.send(data)
+        except socket.error:
+            pass
+        finally:
+            stream.close()
+
+    reader = gevent.spawn(upstream)
+    watcher = gevent.spawn(watch) if idle else None
+    try:
+        while True:
+            data = stream.recv()
+            if data is None:
+                break
+            sock.sendall(data)
+            stream.consumed(len(data))
+    except socket.error:
+        pass
+    finally:
+        stream.close()
+        sock.close()
+        reader.join()
+        if watcher is not None:
+            watcher.kill()
+    return bool(expired)
@@ -0,0 +1,167 @@
+import sys
+import os
+import math
+import mmap
+import time
+import struct
+import bisect
+import logging
+from array import array
+from itertools import compress
+import numpy as np
+
+SEGMENT = 1 << 16
+DEFAULT_COUNT = 120000          # RSA() draws from the 80000th-120000th primes
+
+
+def prime_limit(count):
+    """ Upper bound for the count-th prime (Rosser's bound, count >= 6) """
+    if count < 6:
+        return 15
+    return int(count * (math.log(count) + math.log(math.log(count)))) + 1
+
+
+def sieve(limit, segment=SEGMENT):
+    """ Segmented sieve of Eratosthenes, returns all primes <= limit """
+    root = int(limit ** 0.5) + 1
+    base = bytearray([1]) * (root + 1)
+    base[0:2] = '\x00\x00'
+    for i in xrange(2, int(root ** 0.5) + 1):
+        if base[i]:
+            base[i*i::i] = bytearray(len(xrange(i*i, root + 1, i)))
+    base_primes = [i for i in xrange(2, min(root, limit) + 1) if base[i]]
+
+    primes = array('I', base_primes)
+    for lo in xrange(root + 1, limit + 1, segment):
+        hi = min(lo + segment, limit + 1)
+        seg = bytearray([1]) * (hi - lo)
+        for p in base_primes:
+            if p * p >= hi:
+                break
+            start = max(p * p, (lo + p - 1) // p * p)
+            seg[start-lo::p] = bytearray(len(xrange(start, hi, p)))
+        primes.extend(compress(xrange(lo, hi), seg))
+    return primes
+
+
+class PrimeTable(object):
+    """ The first `count` primes as a compact uint32 array (or an mmap of one) """
+
+    def __init__(self, count=DEFAULT_COUNT, data=None):
+        if data is None:
+            data = sieve(prime_limit(count))[:count]
+        self.data = data
+        self.count = count
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(len(data) // 4, _MappedArray(data))
+
+    def save(self, path):
+        data = array('I', self.data)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        with open(path, 'wb') as f:
+            data.tofile(f)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return int(self.data[i])
+
+    def nth(self, n):
+        """ n-th prime, 1-based """
+        return self[n - 1]
+
+    def random(self, lower_bound, upper_bound):
+        """ Random prime whose index is in [lower_bound, upper_bound) """
+        return self.nth(np.random.randint(lower_bound, upper_bound))
+
+    def random_between(self, lo, hi):
+        """ Random prime p with lo <= p < hi """
+        i = bisect.bisect_left(self, lo)
+        j = bisect.bisect_left(self, hi)
+        assert i < j, 'no prime in [%d, %d)' % (lo, hi)
+        return self[np.random.randint(i, j)]
+
+
+class _MappedArray(object):
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self.buf, 4 * i)[0]
+
+
+_table = None
+
+
+def get_prime_table(count=DEFAULT_COUNT):
+    global _table
+    if _table is None or len(_table) < count:
+        _table = PrimeTable(max(count, DEFAULT_COUNT))
+    return _table
+
+
+def nth_prime(n):
+    return get_prime_table(n).nth(n)
+
+
+def load_primes(config):
+    """ Build the table once at startup, or map it from config['prime_table'] """
+    global _table
+    path = config.get('prime_table')
+    if path and os.path.exists(path):
+        _table = PrimeTable.from_file(path)
+        logging.info("mapped %d primes from %s" % (len(_table), path))
+    else:
+        get_prime_table()
+        if path:
+            _table.save(path)
+    return _table
+
+
+def _find_random_prime_loop(lower_bound, upper_bound):
+    """ The original linear gmpy.is_prime search, for comparison """
+    try:
+        import gmpy
+    except ImportError:
+        import gmpy2 as gmpy
+    index = np.random.randint(lower_bound, upper_bound)
+    count = 0
+    i = 1
+    while count < index:
+        i += 1
+        if gmpy.is_prime(i):
+            count += 1
+    return i
+
+
+if __name__ == '__main__':
+    t = time.time()
+    table = PrimeTable()
+    print('sieve %d primes: %.1fms, %d bytes' % (len(table), (time.time() - t) * 1000,
+                                               table.data.itemsize * len(table.data)))
+
+    path = '/tmp/easysocks-primes.bin'
+    table.save(path)
+    t = time.time()
+    mapped = PrimeTable.from_file(path)
+    print('mmap load: %.3fms' % ((time.time() - t) * 1000))
+    assert mapped.nth(120000) == table.nth(120000) == 1583539
+
+    for name, t_ in [('array', table), ('mmap', mapped)]:
+        t = time.time()
+        for i in xrange(100000):
+            t_.random(80000, 120000)
+        print('%s random prime: %.2fus/call' % (name, (time.time() - t) * 10))
+
+    np.random.seed(1)
+    t = time.time()
+    old = [_find_random_prime_loop(80000, 120000) for i in xrange(3)]
+    print('loop random prime: %.2fms/call' % ((time.time() - t) * 1000 / 3))
+    np.random.seed(1)
+    assert old == [table.random(80000, 120000) for i in xrange(3)]
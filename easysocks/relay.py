@@ -0,0 +1,561 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import heapq
+import socket
+import logging
+import threading
+import _socket
+from collections import deque
+from bufpool import BufferPool
+from timerwheel import TimerWheel
+
+# Tunnels are relayed by a few event loops instead of a select() loop per
+# connection. Each loop owns an epoll set; a handler hands over its two
+# sockets (as dups, so SocketServer can close its own copy) and returns.
+# Under gevent a loop is a greenlet waiting on the epoll fd; without it
+# (socks/server.py, python 3) a loop is a thread blocking in epoll.poll().
+#
+# Per direction at most one buffer of unsent data is held: while it is
+# pending the source is not read (no EPOLLIN) and the destination waits for
+# EPOLLOUT, so a slow reader throttles the writer instead of growing memory.
+# Buffers come from the loop's pool and go back as soon as they are sent:
+# data is received into them, run through the flow's cipher stream in place
+# and sent from a memoryview, so partial sends never copy and idle tunnels
+# hold no buffer.
+#
+# Read sizes adapt per flow: a read that fills its buffer doubles the next
+# one (up to max_read), a short one halves it, and a flow that was quiet
+# for idle_reset seconds starts over at min_read. With coalesce on, a source
+# keeps reading into the same buffer while its destination is blocked, so
+# the next EPOLLOUT sends several reads at once; that never delays data
+# that could have been sent right away.
+#
+# With an idle limit (config "timeout") each loop keeps its tunnels on a
+# timer wheel. Traffic only stamps tunnel.active; when a tunnel's slot comes
+# up it is either rescheduled from that stamp or closed, all expired ones in
+# one sweep per tick.
+#
+# A tunnel may carry shaping paths (shaping.py), one per direction. A read
+# takes at most what its path allows; when that is nothing the flow is held:
+# it loses EPOLLIN and goes on a heap the loop wakes it from once tokens are
+# due, so an over-quota source stays unread in the kernel.
+#
+# A tunnel may carry a watch (upstream.HttpTracker): it is shown the bytes
+# sent to and received from b as plaintext, and when the tunnel finishes
+# with b still open it is offered b to keep instead of it being closed.
+EPOLLIN = 0x001
+EPOLLOUT = 0x004
+EPOLLERR = 0x008
+EPOLLHUP = 0x010
+
+MIN_READ = 4096
+MAX_READ = 256 * 1024
+IDLE_RESET = 1.0                # seconds without a read before a flow's size drops back
+POOL_BYTES = 16 << 20           # free buffers kept per size class
+UNLIMITED = sys.maxsize
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def _cooperative():
+    """ True when gevent has patched socket, i.e. we are a greenlet among greenlets """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def _epoll():
+    if _cooperative():
+        import gevent.monkey
+        return gevent.monkey.get_original('select', 'epoll')()
+    return select.epoll()
+
+
+def _raw(sock):
+    """ A nonblocking plain socket on a dup of sock's fd """
+    if hasattr(_socket, 'fromfd'):
+        raw = _socket.fromfd(sock.fileno(), sock.family, sock.type)
+    else:
+        raw = _socket.socket(sock.family, sock.type, 0, os.dup(sock.fileno()))
+    raw.setblocking(0)
+    return raw
+
+
+class Flow(object):
+    """ One direction of a tunnel """
+    __slots__ = ('src', 'dst', 'cipher', 'buf', 'start', 'end', 'eof', 'bytes',
+                 'size', 'peak', 'last', 'reads', 'sends', 'path', 'held')
+
+    def __init__(self, src, dst, cipher, size, path=None):
+        self.src = src
+        self.dst = dst
+        self.cipher = cipher            # cipher.py stream, None to copy as is
+        self.buf = None                 # pooled Buffer while data is in flight
+        self.start = self.end = 0       # unsent data is buf[start:end]
+        self.eof = False
+        self.bytes = 0
+        self.size = self.peak = size    # buffer size for the next read
+        self.last = 0                   # when the last buffer was taken
+        self.reads = 0
+        self.sends = 0
+        self.path = path                # shaping.Path, None when not shaped
+        self.held = False               # over quota: not read until the loop wakes it
+
+    @property
+    def pending(self):
+        return self.end > self.start
+
+    @property
+    def room(self):
+        return self.buf is None or self.end < len(self.buf.data)
+
+
+class Tunnel(object):
+
+    def __init__(self, a, b, a_to_b=None, b_to_a=None, on_close=None, size=MIN_READ, watch=None, shape=None):
+        up, down = shape or (None, None)
+        self.socks = (a, b)
+        self.flows = (Flow(a, b, a_to_b, size, up), Flow(b, a, b_to_a, size, down))
+        self.on_close = on_close        # on_close(tunnel)
+        self.watch = watch              # to_b(view), from_b(view), park(b) -> kept
+        self.started = self.active = time.time()
+        self.closed = False
+
+    def stats(self):
+        up, down = self.flows
+        return {'up': up.bytes, 'down': down.bytes,
+                'reads': (up.reads, down.reads), 'sends': (up.sends, down.sends),
+                'read_size': (up.size, down.size), 'peak_read': (up.peak, down.peak),
+                'age': time.time() - self.started}
+
+
+def log_closed(tunnel):
+    logging.info("Finishing close tcp: %(up)d up, %(down)d down, reads %(reads)s, "
+                 "sends %(sends)s, peak read size %(peak_read)s" % tunnel.stats())
+
+
+class RelayEngine(object):
+    """ One event loop relaying any number of tunnels """
+
+    def __init__(self, min_read=MIN_READ, max_read=MAX_READ, idle_reset=IDLE_RESET, coalesce=True, idle=None):
+        self.min_read = min_read
+        self.max_read = max(max_read, min_read)
+        self.idle_reset = idle_reset
+        self.coalesce = coalesce
+        self.pools = {}                 # buffer size -> BufferPool
+        size = min_read
+        while size <= self.max_read:
+            self.pools[size] = BufferPool(size, max(8, POOL_BYTES // size))
+            size *= 2
+        self.epoll = _epoll()
+        self.fds = {}                   # fd -> (tunnel, index of the socket in tunnel.socks)
+        self.interest = {}
+        self.incoming = deque()         # tunnels handed over from other greenlets/threads
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.epoll.register(self.wake_r, EPOLLIN)
+        self.tunnels = 0
+        self.relayed = 0
+        self.idle = idle
+        self.wheel = TimerWheel(max(1.0, idle / 64.0)) if idle else None
+        self.expired = 0
+        self.reclaimed_fds = 0
+        self.reclaimed_bytes = 0
+        self.holds = []                 # heap of (due, seq, tunnel, side) for held flows
+        self.seq = 0
+        self.deferred = 0
+
+    def start(self):
+        if _cooperative():
+            import gevent
+            gevent.spawn(self.run)
+        else:
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def add(self, tunnel):
+        self.incoming.append(tunnel)
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError as e:
+            if e.errno not in _RETRY:
+                raise
+
+    def run(self):
+        if _cooperative():
+            from gevent.socket import wait_read
+        tick = self.wheel.tick if self.wheel is not None else None
+        while True:
+            timeout = tick
+            if self.holds:
+                due = max(0.0, self.holds[0][0] - time.time())
+                timeout = due if timeout is None else min(timeout, due)
+            if _cooperative():
+                try:
+                    wait_read(self.epoll.fileno(), timeout)
+                except socket.timeout:
+                    pass
+                events = self.epoll.poll(0)
+            else:
+                events = self.epoll.poll(timeout if timeout is not None else 1.0)
+            for fd, event in events:
+                if fd == self.wake_r:
+                    self._accept()
+                    continue
+                entry = self.fds.get(fd)
+                if entry is None:
+                    continue
+                tunnel, side = entry
+                try:
+                    if event & (EPOLLIN | EPOLLHUP | EPOLLERR):
+                        self._read(tunnel, side, event)
+                    if event & EPOLLOUT and not tunnel.closed:
+                        self._write(tunnel, 1 - side)
+                except Exception as e:
+                    logging.warn("relay: %s" % e)
+                    self._close(tunnel)
+            if self.holds:
+                self._unhold()
+            if self.wheel is not None:
+                self._sweep()
+
+    def _hold(self, tunnel, side, due):
+        tunnel.flows[side].held = True
+        self.seq += 1
+        heapq.heappush(self.holds, (due, self.seq, tunnel, side))
+        self.deferred += 1
+        self._update(tunnel)
+
+    def _unhold(self):
+        """ Give held flows whose tokens are due their EPOLLIN back """
+        now = time.time()
+        while self.holds and self.holds[0][0] <= now:
+            due, seq, tunnel, side = heapq.heappop(self.holds)
+            tunnel.flows[side].held = False
+            if not tunnel.closed:
+                self._update(tunnel)
+
+    def _sweep(self):
+        now = time.time()
+        expired = fds = held = 0
+        for tunnel in self.wheel.advance(now):
+            if tunnel.closed:
+                continue
+            if tunnel.active + self.idle > now:
+                self.wheel.schedule(tunnel, tunnel.active + self.idle)
+                continue
+            held += sum(len(flow.buf.data) for flow in tunnel.flows if flow.buf is not None)
+            self._close(tunnel)
+            expired += 1
+            fds += len(tunnel.socks)
+        if expired:
+            self.expired += expired
+            self.reclaimed_fds += fds
+            self.reclaimed_bytes += held
+            logging.info("closed %d idle tunnels: %d fds, %d buffer bytes" % (expired, fds, held))
+
+    def _accept(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in _RETRY:
+                raise
+        while self.incoming:
+            tunnel = self.incoming.popleft()
+            for side, sock in enumerate(tunnel.socks):
+                fd = sock.fileno()
+                self.fds[fd] = (tunnel, side)
+                self.interest[fd] = EPOLLIN
+                self.epoll.register(fd, EPOLLIN)
+            self.tunnels += 1
+            if self.wheel is not None:
+                self.wheel.schedule(tunnel, tunnel.active + self.idle)
+
+    def _read(self, tunnel, side, event=EPOLLIN):
+        flow = tunnel.flows[side]
+        if flow.eof or not flow.room or flow.held:
+            # epoll reports HUP and ERR whatever the interest, so waiting for room or tokens would spin
+            if event & EPOLLERR:
+                self._close(tunnel)     # failed or reset: nothing more goes to or comes from the socket
+            elif event & EPOLLHUP:
+                self._park(tunnel, side)
+            return
+        now = tunnel.active = time.time()
+        allowed = UNLIMITED
+        if flow.path is not None:
+            allowed = flow.path.allowance(now, self.min_read)
+            if not allowed:
+                return self._hold(tunnel, side, now + flow.path.delay(self.min_read))
+        if flow.buf is None:
+            if now - flow.last > self.idle_reset:
+                flow.size = self.min_read   # a new burst starts small
+            flow.last = now
+            flow.buf = self.pools[flow.size].acquire()
+        buf, end = flow.buf, flow.end
+        room = len(buf.data) - end
+        try:
+            n = flow.src.recv_into(buf.view[end:end + min(room, allowed)])
+        except socket.error as e:
+            if not flow.pending:
+                self._release(flow)
+            if e.args[0] in _RETRY:
+                return
+            return self._close(tunnel)
+        if not n:
+            flow.eof = True
+            if not flow.pending:
+                self._release(flow)
+            self._finish(tunnel)
+            return
+        watch = tunnel.watch
+        if watch is not None and side:
+            watch.from_b(buf.view[end:end + n])
+        if flow.cipher is not None:
+            flow.cipher.process_into(buf.data, end, n)
+        if watch is not None and not side:
+            watch.to_b(buf.view[end:end + n])
+        if flow.path is not None:
+            flow.path.take(n)
+        flow.bytes += n
+        flow.reads += 1
+        flow.end += n
+        if n == room and flow.size < self.max_read:
+            flow.size *= 2              # the read filled the buffer: more is coming
+            flow.peak = max(flow.peak, flow.size)
+        elif n < flow.size // 4 and flow.size > self.min_read:
+            flow.size //= 2
+        if end and self.coalesce:
+            self._update(tunnel)        # appended behind a blocked send: EPOLLOUT sends it all
+        else:
+            self._write(tunnel, side)
+
+    def _write(self, tunnel, side):
+        """ Push flow `side`'s pending data to its destination """
+        flow = tunnel.flows[side]
+        if flow.pending:
+            try:
+                sent = flow.dst.send(flow.buf.view[flow.start:flow.end])
+            except socket.error as e:
+                if e.args[0] not in _RETRY:
+                    return self._close(tunnel)
+                sent = 0
+            flow.sends += 1
+            flow.start += sent
+            if not flow.pending:
+                self._release(flow)
+        self._finish(tunnel)
+
+    def _finish(self, tunnel):
+        """ Close once either side has hung up and nothing is left to deliver """
+        up, down = tunnel.flows
+        if (up.eof or down.eof) and not (up.pending or down.pending):
+            return self._close(tunnel, finished=True)
+        self._update(tunnel)
+
+    def _update(self, tunnel):
+        for side, sock in enumerate(tunnel.socks):
+            flow = tunnel.flows[side]
+            want = 0
+            if not flow.eof and flow.room and not flow.held and (self.coalesce or not flow.pending):
+                want |= EPOLLIN
+            if tunnel.flows[1 - side].pending:
+                want |= EPOLLOUT
+            fd = sock.fileno()
+            if self.interest[fd] is None:
+                if want:                # parked: back in, where a hang up with nothing to read closes it
+                    self.epoll.register(fd, want)
+                    self.interest[fd] = want
+            elif self.interest[fd] != want:
+                self.epoll.modify(fd, want)
+                self.interest[fd] = want
+
+    def _park(self, tunnel, side):
+        """ Hung up, data may still be unread: out of epoll until _update wants the socket again """
+        fd = tunnel.socks[side].fileno()
+        if self.interest[fd] is not None:
+            self.epoll.unregister(fd)
+            self.interest[fd] = None
+
+    def _release(self, flow):
+        self.pools[len(flow.buf.data)].release(flow.buf)
+        flow.buf = None
+        flow.start = flow.end = 0
+
+    def _close(self, tunnel, finished=False):
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        for flow in tunnel.flows:
+            if flow.buf is not None:
+                self._release(flow)
+            if flow.path is not None:
+                flow.path.close()
+        for side, sock in enumerate(tunnel.socks):
+            fd = sock.fileno()
+            if self.fds.pop(fd, None) is not None and self.interest.pop(fd, None) is not None:
+                self.epoll.unregister(fd)
+            if side and finished and tunnel.watch is not None and not tunnel.flows[1].eof \
+                    and tunnel.watch.park(sock):
+                continue                # b lives on for another tunnel
+            sock.close()
+        self.tunnels -= 1
+        self.relayed += 1
+        if tunnel.on_close:
+            tunnel.on_close(tunnel)
+
+    def live(self):
+        return set(tunnel for tunnel, side in self.fds.values())
+
+    def allocated(self):
+        return sum(pool.allocated for pool in self.pools.values())
+
+
+class Relay(object):
+    """ Spreads tunnels over `loops` engines, least loaded first """
+
+    def __init__(self, loops=1, min_read=MIN_READ, max_read=MAX_READ, idle_reset=IDLE_RESET, coalesce=True,
+                 idle=None):
+        self.engines = [RelayEngine(min_read, max_read, idle_reset, coalesce, idle).start()
+                        for i in range(max(1, loops))]
+        self.min_read = min_read
+
+    def add(self, a, b, a_to_b=None, b_to_a=None, on_close=None, watch=None, shape=None):
+        """
+        Relay between sockets a and b until either side closes, translating
+        each direction through the given cipher stream and shaping it by the
+        given (a_to_b, b_to_a) paths. Takes ownership: a and b are closed
+        here, the engine works on its own copies.
+        """
+        tunnel = Tunnel(_raw(a), _raw(b), a_to_b, b_to_a, on_close, self.min_read, watch, shape)
+        a.close()
+        b.close()
+        min(self.engines, key=lambda e: e.tunnels + len(e.incoming)).add(tunnel)
+        return tunnel
+
+    def stats(self):
+        return {'tunnels': sum(e.tunnels for e in self.engines),
+                'relayed': sum(e.relayed for e in self.engines),
+                'buffers': sum(e.allocated() for e in self.engines),
+                'expired': sum(e.expired for e in self.engines),
+                'reclaimed_fds': sum(e.reclaimed_fds for e in self.engines),
+                'reclaimed_bytes': sum(e.reclaimed_bytes for e in self.engines),
+                'deferred': sum(e.deferred for e in self.engines),
+                'loops': len(self.engines)}
+
+    def tunnel_stats(self):
+        return [t.stats() for e in self.engines for t in e.live()]
+
+
+class RelayServerMixin:
+    """
+    For SocketServer servers whose handlers give their request to a Relay:
+    the request must then only be closed, shutdown() would end the tunnel.
+    """
+    detached = None
+
+    def detach(self, request):
+        if self.detached is None:
+            self.detached = set()
+        self.detached.add(id(request))
+
+    def shutdown_request(self, request):
+        if self.detached and id(request) in self.detached:
+            self.detached.discard(id(request))
+        else:
+            try:
+                request.shutdown(socket.SHUT_WR)    # as TCPServer.shutdown_request
+            except socket.error:
+                pass
+        self.close_request(request)
+
+
+def load_relay(config):
+    return Relay(config.get('relay_loops', 1), config.get('relay_min_read', MIN_READ),
+                 config.get('relay_max_read', MAX_READ), config.get('relay_idle_reset', IDLE_RESET),
+                 config.get('relay_coalesce', True), config.get('timeout', 600))
+
+
+def _copy_loop(sock, remote, table, counts):
+    """ The old handle_tcp: recv, translate and sliced sends, one direction; counts temporary strings """
+    while True:
+        data = sock.recv(4096)
+        counts[0] += 1
+        if not data:
+            break
+        data = data.translate(table)
+        counts[0] += 1
+        sent = remote.send(data)
+        while sent < len(data):
+            sent += remote.send(data[sent:])
+            counts[0] += 1
+    remote.close()
+
+
+def _bulk(start, total, chunk=1 << 16):
+    """ Push total bytes through a tunnel set up by start(a, b), returns seconds """
+    src, a = socket.socketpair()
+    b, dst = socket.socketpair()
+    start(a, b)
+    block = os.urandom(chunk)
+    writer = threading.Thread(target=lambda: [src.sendall(block) for i in range(total // chunk)] and src.close())
+    t = time.time()
+    writer.start()
+    got = 0
+    while True:
+        n = len(dst.recv(1 << 16))
+        if not n:
+            break
+        got += n
+    elapsed = time.time() - t
+    writer.join()
+    assert got == total, (got, total)
+    dst.close()
+    return elapsed
+
+
+def _ping(relay, table, rounds=2000):
+    """ Mean round trip of a 1 byte message through a tunnel and an echo """
+    src, a = socket.socketpair()
+    b, echo = socket.socketpair()
+    relay.add(a, b, TableCipher(table), TableCipher(table))
+    t = time.time()
+    for i in range(rounds):
+        src.send(b'x')
+        echo.send(echo.recv(1))
+        src.recv(1)
+    elapsed = time.time() - t
+    src.close()
+    echo.close()
+    time.sleep(0.1)
+    return elapsed / rounds
+
+
+if __name__ == '__main__':
+    from cipher import TableCipher
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 256 << 20
+    table = bytes(bytearray((i * 7 + 3) % 256 for i in range(256)))
+
+    counts = [0]
+    def old(a, b):
+        t = threading.Thread(target=_copy_loop, args=(a, b, table, counts))
+        t.daemon = True
+        t.start()
+    elapsed = _bulk(old, total)
+    print('copy loop       %7.1f MB/s, %d temporary strings' % (total / elapsed / 1e6, counts[0]))
+
+    for name, relay in [('relay 4K', Relay(1, 4096, 4096)), ('relay adaptive', Relay())]:
+        tunnels = []
+        elapsed = _bulk(lambda a, b: tunnels.append(relay.add(a, b, TableCipher(table))), total)
+        time.sleep(0.1)
+        stats = tunnels[0].stats()
+        # TableCipher.process_into makes two temporaries per read, counted like the copy loop's
+        print('%-15s %7.1f MB/s, %d temporary strings, %d buffers allocated, %d reads, %d sends, peak read %d' % (
+            name, total / elapsed / 1e6, 2 * stats['reads'][0], relay.stats()['buffers'], stats['reads'][0],
+            stats['sends'][0], stats['peak_read'][0]))
+        print('%-15s %7.1f us round trip for 1 byte' % (name, _ping(relay, table) * 1e6))
@@ -0,0 +1,512 @@
+import sys
+import time
+import random
+import socket
+import struct
+import threading
+from collections import OrderedDict
+
+# Names in CONNECT requests are resolved here instead of by a blocking
+# getaddrinfo per request: a small stub resolver speaking DNS over UDP
+# (TCP when the answer is truncated) to the nameservers in resolv.conf or
+# config['dns_servers']. Answers are cached per (name, type) for their
+# TTL, NXDOMAIN/NODATA for the SOA's negative TTL (RFC 2308), in an LRU of
+# dns_cache_size entries. Concurrent lookups of one name share a single
+# query. Works in py2 and py3, with gevent or with threads.
+A = 1
+SOA = 6
+AAAA = 28
+QTYPES = {socket.AF_INET: A, socket.AF_INET6: AAAA}
+NOERROR = 0
+NXDOMAIN = 3
+DNS_PORT = 53
+
+
+class ResolveError(socket.gaierror):
+    pass
+
+
+def _text(name):
+    if not isinstance(name, str):
+        name = name.decode('ascii', 'replace')
+    return name.lower().rstrip('.')
+
+
+def _literal(name):
+    """ (family, address) when name is an IP address already """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, name)
+            return family, name
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def _spawn(func, *args):
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        import gevent
+        gevent.spawn(func, *args)
+    else:
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+
+
+def read_nameservers(path='/etc/resolv.conf'):
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    servers.append((fields[1], DNS_PORT))
+    except IOError:
+        pass
+    return servers or [('127.0.0.1', DNS_PORT)]
+
+
+def read_hosts(path='/etc/hosts'):
+    """ name -> [(family, address)] """
+    hosts = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                literal = fields and _literal(fields[0])
+                if not literal:
+                    continue
+                for name in fields[1:]:
+                    entry = hosts.setdefault(_text(name), [])
+                    if literal not in entry:
+                        entry.append(literal)
+    except IOError:
+        pass
+    return hosts
+
+
+def build_query(qid, name, qtype):
+    labels = [label for label in name.encode('idna').split(b'.') if label]
+    qname = b''.join(struct.pack('!B', len(label)) + label for label in labels) + b'\0'
+    return struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + qname + struct.pack('!HH', qtype, 1)
+
+
+def _skip_name(buf, i):
+    while True:
+        n = buf[i]
+        if n == 0:
+            return i + 1
+        if n & 0xc0 == 0xc0:
+            return i + 2
+        i += n + 1
+
+
+def parse_response(data):
+    """
+    (id, rcode, truncated, [(family, address)], ttl). ttl is the smallest
+    over the answer chain, or for an empty answer the SOA's negative TTL
+    (None when there is no SOA). Malformed data raises ValueError.
+    """
+    buf = bytearray(data)
+    try:
+        qid, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', data)
+        if not flags & 0x8000:
+            raise ValueError('not a response')
+        i = 12
+        for n in range(qdcount):
+            i = _skip_name(buf, i) + 4
+        addrs = []
+        answer_ttl = negative_ttl = None
+        for n in range(ancount + nscount):
+            i = _skip_name(buf, i)
+            rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', data, i)
+            i += 10
+            rdata = data[i:i + rdlength]
+            if n < ancount:
+                if rtype == A and rdlength == 4:
+                    addrs.append((socket.AF_INET, socket.inet_ntop(socket.AF_INET, rdata)))
+                elif rtype == AAAA and rdlength == 16:
+                    addrs.append((socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, rdata)))
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+            elif rtype == SOA:
+                j = _skip_name(buf, _skip_name(buf, i))
+                minimum = struct.unpack_from('!I', data, j + 16)[0]
+                negative_ttl = min(ttl, minimum)
+            i += rdlength
+    except (IndexError, struct.error, socket.error) as e:
+        raise ValueError('malformed response: %s' % e)
+    return qid, flags & 0xf, bool(flags & 0x200), addrs, answer_ttl if addrs else negative_ttl
+
+
+class DnsCache(object):
+    """ LRU of (name, qtype) -> addresses until a deadline; [] is a cached negative answer """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, addrs = entry
+            if time.time() >= expires:
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            if addrs:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return addrs
+
+    def put(self, key, addrs, ttl):
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, addrs)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'negative_hits': self.negative_hits,
+                'misses': self.misses, 'expired': self.expired, 'evicted': self.evicted}
+
+
+class _Flight(object):
+    """ One outstanding query; later askers for the same name wait on it """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Resolver(object):
+    """
+    resolve(name) -> [(family, address)], IPv4 first, raising ResolveError
+    (a socket.gaierror) for names that do not exist or could not be looked
+    up. Only answers are cached; timeouts and SERVFAIL are not.
+    """
+
+    def __init__(self, servers=None, cache_size=4096, timeout=2.0, attempts=2,
+                 negative_ttl=30, max_ttl=86400, hosts=None, families=(socket.AF_INET, socket.AF_INET6)):
+        self.servers = [tuple(s) if isinstance(s, (list, tuple)) else (s, DNS_PORT)
+                        for s in servers or []] or read_nameservers()
+        self.cache = DnsCache(cache_size)
+        self.timeout = timeout
+        self.attempts = attempts
+        self.negative_ttl = negative_ttl        # default and ceiling for negative answers
+        self.max_ttl = max_ttl
+        self.hosts = read_hosts() if hosts is None else hosts
+        self.qtypes = [QTYPES[f] for f in families]
+        self.flights = {}                       # name -> _Flight
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def resolve(self, name):
+        name = _text(name)
+        addrs = self.cached(name)
+        if addrs is None:
+            addrs = self._join(name)
+        if not addrs:
+            raise ResolveError(socket.EAI_NONAME, 'cannot resolve %s' % name)
+        return addrs
+
+    def cached(self, name):
+        """ Without waiting: the known answer ([] for a cached miss), or None """
+        name = _text(name)
+        literal = _literal(name)
+        if literal:
+            return [literal]
+        if name in self.hosts:
+            return list(self.hosts[name])
+        found = []
+        for qtype in self.qtypes:
+            addrs = self.cache.get((name, qtype))
+            if addrs is None:
+                return None
+            found.extend(addrs)
+        return found
+
+    def resolve_async(self, name, callback):
+        """
+        For event loops that must not wait: callback(addrs, error) is called
+        right away when the answer is known, otherwise from a greenlet (or
+        thread) once the query finishes.
+        """
+        if self.cached(name) is not None:
+            self._deliver(name, callback)
+        else:
+            _spawn(self._deliver, name, callback)
+
+    def _deliver(self, name, callback):
+        try:
+            addrs = self.resolve(name)
+        except ResolveError as e:
+            callback(None, e)
+        else:
+            callback(addrs, None)
+
+    def _join(self, name):
+        with self.lock:
+            flight = self.flights.get(name)
+            leader = flight is None
+            if leader:
+                flight = self.flights[name] = _Flight()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                flight.result = self._query(name)
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self.flights[name]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _query(self, name):
+        self.queries += 1
+        try:
+            answers = self._exchange(name)
+        except ResolveError:
+            self.failed += 1
+            raise
+        found = []
+        for qtype in self.qtypes:
+            addrs, ttl = answers[qtype]
+            if addrs:
+                ttl = min(ttl, self.max_ttl)
+            else:
+                ttl = self.negative_ttl if ttl is None else min(ttl, self.negative_ttl)
+            self.cache.put((name, qtype), addrs, ttl)
+            found.extend(addrs)
+        return found
+
+    def _exchange(self, name):
+        """ qtype -> (addrs, ttl) from the first nameserver that answers all of them """
+        try:
+            queries = dict((random.randint(0, 0xffff), qtype) for qtype in self.qtypes)
+            while len(queries) < len(self.qtypes):      # ids collided
+                queries = dict((random.randint(0, 0xffff), qtype) for qtype in self.qtypes)
+            packets = dict((qid, build_query(qid, name, qtype)) for qid, qtype in queries.items())
+        except UnicodeError as e:
+            raise ResolveError(socket.EAI_NONAME, 'bad name %r: %s' % (name, e))
+        error = None
+        for attempt in range(self.attempts):
+            for server in self.servers:
+                try:
+                    return self._udp(server, queries, packets)
+                except (socket.error, ValueError) as e:
+                    error = e
+        raise ResolveError(socket.EAI_AGAIN, 'resolving %s failed: %s' % (name, error))
+
+    def _udp(self, server, queries, packets):
+        family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.connect(server)
+            for packet in packets.values():
+                sock.send(packet)
+            answers = {}
+            deadline = time.time() + self.timeout
+            while len(answers) < len(queries):
+                left = deadline - time.time()
+                if left <= 0:
+                    raise socket.timeout('no answer from %s:%d' % server)
+                sock.settimeout(left)
+                data = sock.recv(4096)
+                try:
+                    qid, rcode, truncated, addrs, ttl = parse_response(data)
+                except ValueError:
+                    continue                            # junk, keep waiting
+                if qid not in queries or qid in answers:
+                    continue
+                if truncated:
+                    qid, rcode, truncated, addrs, ttl = self._tcp(server, packets[qid], deadline)
+                if rcode not in (NOERROR, NXDOMAIN):
+                    raise ValueError('%s:%d answered rcode %d' % (server[0], server[1], rcode))
+                answers[qid] = (addrs, ttl)
+            return dict((queries[qid], answer) for qid, answer in answers.items())
+        finally:
+            sock.close()
+
+    def _tcp(self, server, packet, deadline):
+        sock = socket.create_connection(server, max(deadline - time.time(), 0.01))
+        try:
+            sock.sendall(struct.pack('!H', len(packet)) + packet)
+            data = b''
+            while len(data) < 2 or len(data) < 2 + struct.unpack('!H', data[:2])[0]:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ValueError('short TCP answer from %s:%d' % server)
+                data += chunk
+            return parse_response(data[2:])
+        finally:
+            sock.close()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({'queries': self.queries, 'coalesced': self.coalesced,
+                      'failed': self.failed, 'inflight': len(self.flights)})
+        return stats
+
+
+def load_resolver(config):
+    return Resolver(config.get('dns_servers'), config.get('dns_cache_size', 4096),
+                    config.get('dns_timeout', 2.0), negative_ttl=config.get('dns_negative_ttl', 30))
+
+
+class StubServer(object):
+    """
+    A nameserver for testing: records maps name -> [(qtype, address, ttl)],
+    other names get NXDOMAIN. Answers after `delay` seconds; names in
+    `truncate` are answered with TC set over UDP and in full over TCP.
+    """
+
+    def __init__(self, records, delay=0, truncate=(), host='127.0.0.1'):
+        self.records = records
+        self.delay = delay
+        self.truncate = set(truncate)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, 0))
+        self.address = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.address)
+        self.tcp.listen(16)
+        self.queries = 0
+
+    def start(self):
+        _spawn(self._serve_udp)
+        _spawn(self._serve_tcp)
+        return self
+
+    def _serve_udp(self):
+        while True:
+            data, peer = self.udp.recvfrom(4096)
+            _spawn(self._answer_udp, data, peer)
+
+    def _answer_udp(self, data, peer):
+        self.udp.sendto(self.answer(data, udp=True), peer)
+
+    def _serve_tcp(self):
+        while True:
+            conn, peer = self.tcp.accept()
+            data = b''
+            while len(data) < 2 or len(data) < 2 + struct.unpack('!H', data[:2])[0]:
+                data += conn.recv(4096)
+            reply = self.answer(data[2:])
+            conn.sendall(struct.pack('!H', len(reply)) + reply)
+            conn.close()
+
+    def answer(self, query, udp=False):
+        self.queries += 1
+        time.sleep(self.delay)
+        buf = bytearray(query)
+        qid = struct.unpack_from('!H', query)[0]
+        labels, i = [], 12
+        while buf[i]:
+            labels.append(query[i + 1:i + 1 + buf[i]].decode('ascii'))
+            i += buf[i] + 1
+        qtype = struct.unpack_from('!H', query, i + 1)[0]
+        question = query[12:i + 5]
+        name = '.'.join(labels).lower()
+        if name not in self.records:
+            return self._reply(qid, NXDOMAIN, question, [], soa=True)
+        if udp and name in self.truncate:
+            return struct.pack('!HHHHHH', qid, 0x8380, 1, 0, 0, 0) + question
+        answers = [(rtype, addr, ttl) for rtype, addr, ttl in self.records[name] if rtype == qtype]
+        return self._reply(qid, NOERROR, question, answers, soa=not answers)
+
+    def _reply(self, qid, rcode, question, answers, soa=False):
+        packet = struct.pack('!HHHHHH', qid, 0x8180 | rcode, 1, len(answers), int(soa), 0) + question
+        for rtype, addr, ttl in answers:
+            rdata = socket.inet_pton(socket.AF_INET if rtype == A else socket.AF_INET6, addr)
+            packet += struct.pack('!HHHIH', 0xc00c, rtype, 1, ttl, len(rdata)) + rdata
+        if soa:
+            rdata = b'\0\0' + struct.pack('!IIIII', 1, 3600, 600, 86400, 5)
+            packet += struct.pack('!HHHIH', 0xc00c, SOA, 1, 60, len(rdata)) + rdata
+        return packet
+
+
+if __name__ == '__main__':
+    stub = StubServer({'example.test': [(A, '10.0.0.1', 60), (A, '10.0.0.2', 60), (AAAA, 'fd00::1', 60)],
+                       'v4only.test': [(A, '10.0.0.3', 60)],
+                       'short.test': [(A, '10.0.0.4', 1)],
+                       'slow.test': [(A, '10.0.0.5', 60)],
+                       'big.test': [(A, '10.1.0.%d' % i, 60) for i in range(1, 41)]},
+                      truncate=['big.test']).start()
+    resolver = Resolver([stub.address], hosts={}, timeout=0.5)
+
+    def timed(name):
+        start = time.time()
+        try:
+            result = resolver.resolve(name)
+        except ResolveError as e:
+            result = e
+        return result, (time.time() - start) * 1e6
+
+    for name in ['example.test', 'example.test', 'v4only.test', 'missing.test', 'missing.test',
+                 'big.test', '127.0.0.1', '::1']:
+        result, us = timed(name)
+        print('%-14s %8.0f us  queries %d  %s' % (name, us, stub.queries, result))
+    assert len(resolver.resolve('big.test')) == 40
+
+    resolver.resolve('short.test')
+    before = stub.queries
+    time.sleep(1.1)
+    resolver.resolve('short.test')
+    print('ttl expiry: %d queries after 1s' % (stub.queries - before))
+    assert stub.queries - before == 2
+
+    stub.delay = 0.2
+    before = stub.queries
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve('slow.test'))) for i in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print('50 concurrent lookups: %d queries, %d coalesced' % (stub.queries - before, resolver.coalesced))
+    assert stub.queries - before == 2 and len(results) == 50
+
+    done = threading.Event()
+    resolver.resolve_async('example.test', lambda addrs, error: done.set())
+    assert done.is_set()                        # cached: called back right away
+    stub.delay = 0
+    done.clear()
+    resolver.resolve_async('async.test', lambda addrs, error: done.set())
+    assert not done.is_set() and done.wait(1)
+
+    dead = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dead.bind(('127.0.0.1', 0))
+    failover = Resolver([dead.getsockname(), stub.address], hosts={}, timeout=0.2, attempts=1)
+    start = time.time()
+    result = failover.resolve('v4only.test')
+    print('past a dead server in %.2fs: %s' % (time.time() - start, result))
+    print(resolver.stats())
@@ -9,26 +9,34 @@ import struct
 import string
 import hashlib
 import os
+import time
 import json
 import logging
 import getopt
-from rsa import RSA
-from pyDes import des, PAD_PKCS5, ECB
-
-def get_table(key):
-    m = hashlib.md5()
-    m.update(key)
-    s = m.digest()
-    (a, b) = struct.unpack('<QQ', s)
-    table = [c for c in string.maketrans('', '')]
-    for i in xrange(1, 1024):
-        table.sort(lambda x, y: int(a % (ord(x) + i) - a % (ord(y) + i)))
-    return table
+from rsa import detect_codec
+from table import load_tables
+from cipher import load_cipher
+from keypool import start_key_pool
+from primes import load_primes
+from ticket import load_tickets
+from mux import MuxSession, pipe
+from relay import load_relay, log_closed, RelayServerMixin
+from timerwheel import load_timeouts
+from resolver import load_resolver
+from connector import load_connector
+from upstream import load_upstreams
+from workers import supervise, bind_server
+from stats import Metrics, StatsServer, count_tunnel
+from shaping import load_shaper
+from admission import AdmissionServerMixin, load_admission
+from handshake import (ServerHandshake, HandshakeError, HANDSHAKE_V2, STATUS_UNREACHABLE, STATUS_BUSY,
+                       F_ADDR, F_DATA, F_MUX, F_DEFER, F_OWNER, read_frames, recv_exact, parse_addr, reject)
 
 def send_all(sock, data):
+    view = memoryview(data)             # partial sends must not copy the rest
     bytes_sent = 0
     while True:
-        r = sock.send(data[bytes_sent:])
+        r = sock.send(view[bytes_sent:])
         if r < 0:
             return r
         bytes_sent += r
@@ -36,74 +44,54 @@ def send_all(sock, data):
             return bytes_sent
 
 
-def find_random_prime(lower_bound=20, upper_bound=30, seed=0):
-    assert (lower_bound >= 1), "Lower_bound must be no less than 1."
-    np.random.seed(seed=seed)
-    index = np.random.randint(lower_bound, upper_bound)
+def tunnel_closed(tunnel, slot):
+    slot.release()
+    log_closed(tunnel)
+    count_tunnel(metrics, tunnel)
 
-    prime_list = []
-    
-    i = 2
-    while(True):
-        if (len(prime_list) >= index):
-            break
-        if gmpy.is_prime(i):
-            prime_list.append(i)
-        i += 1
-
-    return prime_list[index-1]
 
-
-class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class ThreadingTCPServer(AdmissionServerMixin, RelayServerMixin, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     allow_reuse_address = True
+    request_queue_size = 128        # "accept_backlog"
 
 
 class Socks5Server(SocketServer.StreamRequestHandler):
     # TODO
     exchanged = False
+    destination = None  # (host, port) of the last connect_remote
+    pool_key = None     # (client, owner, host, port) for origin connection reuse, None for none
+    rbufsize = 0        # rfile must not read ahead into the key exchange
 
-    def handle_tcp(self, sock, remote):
-        try:
-            fdset = [sock, remote]
-            while True:
-                r, w, e = select.select(fdset, [], [])
-                if sock in r:
-                    data = sock.recv(4096)
-                    data = self.DES_decrypt(data)
-                    if len(data) <= 0:
-                        break
-                    result = send_all(remote, data)
-                    if result < len(data):
-                        raise Exception('failed to send all data')
-                if remote in r:
-                    data = remote.recv(4096)
-                    data = self.DES_encrypt(data)
-                    if len(data) <= 0:
-                        break
-                    result = send_all(sock, data)
-                    if result < len(data):
-                        raise Exception('failed to send all data')
-
-        finally:
-            sock.close()
-            remote.close()
+    def handle_tcp(self, sock, remote, early_data=''):
+        """ Hand the tunnel to the relay engine, it outlives this handler """
+        watch = upstreams.tracker(self.pool_key)         # may keep remote alive for reuse
+        if early_data:
+            send_all(remote, early_data)
+            if watch:
+                watch.to_b(memoryview(early_data))
+        self.server.detach(self.request)
+        slot = self.server.slot(self.request)
+        slot.established(detached=True)
+        # the server never learns SOCKS usernames: a client address is a user here
+        relay.add(sock, remote, self.decryptor, self.encryptor, lambda tunnel: tunnel_closed(tunnel, slot),
+                  watch, shaper.paths(self.client_address[0]))
     
     def exchange_key(self, sock, remote):
-        self.rsa = RSA()
+        self.rsa = keys.get()
         try:
             # 1. receive public key
-            remote_pubkey = self.decrypt(sock.recv(4096)).decode('utf-8')
-            self.remote_pubkey = [self.rsa.unstringfied(k) for k in remote_pubkey.decode('utf-8').strip().split('-')]
+            remote_pubkey = self.decrypt(sock.recv(4096))
+            codec = detect_codec(remote_pubkey)                 # answer in the peer's format
+            self.remote_pubkey = codec.unpack_pubkey(self.rsa, remote_pubkey)
             logging.info("Server receive pubkey: %s" % self.remote_pubkey)
 
             # 2. send public key
-            pub_key = (self.rsa.get_stringfied(self.rsa.e) + '-' + self.rsa.get_stringfied(self.rsa.n)).encode('utf-8')
+            pub_key = codec.pack_pubkey(self.rsa)
 
             result = send_all(sock, self.encrypt(pub_key))
             
             # 3. identification check
-            id_data = sock.recv(4096).decode('utf-8')
-            id_data = self.rsa._decode(id_data, self.rsa.d, self.rsa.n, self.rsa.k)
+            id_data = codec.decrypt(self.rsa, sock.recv(4096))
             
             id_data = id_data.strip()
             logging.info("Server receive id_data: %s" % id_data)
@@ -112,15 +100,15 @@ class Socks5Server(SocketServer.StreamRequestHandler):
             
             id_seq = str(int(id_data[:-10])+1)
             id_msg = '2017011303'
-            id_data = self.rsa._encode(id_seq+id_msg, self.remote_pubkey[0], self.remote_pubkey[1], self.rsa.k).encode('utf-8')
+            id_data = codec.encrypt(self.rsa, id_seq+id_msg, self.remote_pubkey)
             result = send_all(sock, id_data)
             
             # 4. exchange des key
-            DES_KEY = sock.recv(4096).decode('utf-8')
+            DES_KEY = sock.recv(4096)
             ## decrypt by private B
-            DES_KEY = self.rsa._decode(DES_KEY, self.rsa.d, self.rsa.n, self.rsa.k)
+            DES_KEY = codec.decrypt(self.rsa, DES_KEY)
             ## decrypt by public A
-            DES_KEY = self.rsa._decode(DES_KEY, self.remote_pubkey[0], self.remote_pubkey[1], self.rsa.k)
+            DES_KEY = codec.verify(self.rsa, DES_KEY, self.remote_pubkey)
             
             logging.info("Server exchange complete with DES key %s" % DES_KEY)
             return DES_KEY
@@ -133,6 +121,38 @@ class Socks5Server(SocketServer.StreamRequestHandler):
             # For safety
             return "12345678"
 
+    def mux_open(self, stream, addr_to_send):
+        """ A stream opened on a mux tunnel: connect it and relay """
+        try:
+            remote = self.connect_remote(*parse_addr(addr_to_send))
+        except (HandshakeError, socket.error), e:
+            logging.warn(e)
+            stream.reply(STATUS_UNREACHABLE)
+            return
+        stream.reply(0)
+        remote.settimeout(None)                 # pipe() times out the whole stream instead
+        if pipe(remote, stream, timeouts.idle):
+            timeouts.fired('idle')
+
+    def connect_remote(self, addrtype, addr, port, owner=None):
+        """ owner: the client's tag for its SOCKS user; without one the connection is never shared """
+        self.destination = (addr, port)
+        self.pool_key = (self.client_address[0], owner, addr, port) if owner else None
+        remote = upstreams.get(self.pool_key)
+        if remote is not None:
+            logging.info('reusing connection to %s:%d' % (addr, port))
+            remote.settimeout(timeouts.handshake)
+            return remote
+        logging.info('connecting %s:%d' % (addr, port))
+        try:
+            remote = connector.connect(addr, port, timeouts.connect)     # all addresses, raced
+        except socket.timeout:
+            timeouts.fired('connect')
+            raise socket.error('connect to %s:%d timed out' % (addr, port))
+        remote.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        remote.settimeout(timeouts.handshake)
+        return remote
+
     def encrypt(self, data):
         return data.translate(encrypt_table)
 
@@ -140,15 +160,19 @@ class Socks5Server(SocketServer.StreamRequestHandler):
         return data.translate(decrypt_table)
 
     def DES_encrypt(self, data):
-        return data.translate(self.new_encrypt_table)
+        return self.encryptor.process(data)
     
     def DES_decrypt(self, data):
-        return data.translate(self.new_decrypt_table)
+        return self.decryptor.process(data)
 
     def handle(self):
         try:
             sock = self.connection
-            addrtype = ord(self.decrypt(sock.recv(1)))      # receive addr type
+            sock.settimeout(timeouts.handshake)
+            addrtype = ord(self.decrypt(recv_exact(sock, 1)))   # receive addr type
+            start = time.time()
+            if addrtype == HANDSHAKE_V2:
+                return self.handle_v2(sock, start)
             if addrtype == 1:
                 addr = socket.inet_ntoa(self.decrypt(self.rfile.read(4)))   # get dst addr
             elif addrtype == 4:
@@ -161,27 +185,103 @@ class Socks5Server(SocketServer.StreamRequestHandler):
                 logging.warn('addr_type not support')
                 return
             port = struct.unpack('>H', self.decrypt(self.rfile.read(2)))    # get dst port into small endian
+            start = metrics.time('address_ms', start)
             try:
-                logging.info('connecting %s:%d' % (addr, port[0]))
-                if addrtype == 4:
-                    remote = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-                else:
-                    remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                remote.connect((addr, port[0]))         # connect to dst
+                remote = self.connect_remote(addrtype, addr, port[0])
             except socket.error, e:
                 # Connection refused
+                metrics.count('connect_failures')
                 logging.warn(e)
                 return
+            start = metrics.time('connect_ms', start)
 
             # # TODO
             DES_KEY = self.exchange_key(sock, remote)
-            self.new_encrypt_table = ''.join(get_table(DES_KEY))
-            self.new_decrypt_table = string.maketrans(self.new_encrypt_table, string.maketrans('', ''))
+            start = metrics.time('key_exchange_ms', start)
+            self.encryptor, self.decryptor = ciphers.session(DES_KEY, '', False)
+            metrics.time('cipher_ms', start)
             
             self.handle_tcp(sock, remote)
+        except HandshakeError, e:
+            logging.warn(e)
+        except socket.timeout, e:
+            timeouts.fired('handshake')
+            logging.warn("handshake timed out")
+        except socket.error, e:
+            logging.warn(e)
+
+    def handle_v2(self, sock, start):
+        """ Single flight handshake: the client sent address, key and identity at once """
+        try:
+            hs = ServerHandshake(read_frames(sock, self.decrypt), keys, tickets)
+        except HandshakeError, e:
+            metrics.count('handshake_failures')
+            logging.warn(e)
+            send_all(sock, self.encrypt(reject()))
+            return
+        start = metrics.time('key_exchange_ms', start)  # frames read, key decrypted
+
+        if hs.target == F_MUX:
+            reply, DES_KEY = hs.reply()
+            send_all(sock, self.encrypt(reply))
+            logging.info("Server mux tunnel up with key %s" % DES_KEY)
+            encrypt, decrypt = ciphers.session(DES_KEY, hs.client_share, False)
+            sock.settimeout(timeouts.idle)
+            self.server.slot(self.request).established()
+            MuxSession(sock, encrypt, decrypt, MUX_WINDOW, on_open=self.mux_open).run()
+            return
+        if hs.target == F_DEFER:
+            self.handle_deferred(sock, hs)
+            return
+        try:
+            addrtype, addr, port = parse_addr(hs.addr)
+        except HandshakeError, e:
+            logging.warn(e)
+            send_all(sock, self.encrypt(reject()))
+            return
+        start = time.time()
+        try:
+            remote = self.connect_remote(addrtype, addr, port, hs.owner)
         except socket.error, e:
+            metrics.count('connect_failures')
             logging.warn(e)
+            send_all(sock, self.encrypt(hs.reply(STATUS_UNREACHABLE)[0]))
+            return
+        start = metrics.time('connect_ms', start)
+
+        reply, DES_KEY = hs.reply()
+        send_all(sock, self.encrypt(reply))
+        if hs.resumed:
+            metrics.count('resumed')
+            logging.info("Server resumed session (ticket hit rate %.2f)" % tickets.hit_rate())
+        else:
+            logging.info("Server handshake v2 complete with key %s" % DES_KEY)
+        start = metrics.time('reply_ms', start)
+        self.encryptor, self.decryptor = ciphers.session(DES_KEY, hs.client_share, False)
+        metrics.time('cipher_ms', start)
+        self.handle_tcp(sock, remote, hs.early_data)
+
+    def handle_deferred(self, sock, hs):
+        """ A warm connection from the client's pool: keyed now, address later """
+        reply, DES_KEY = hs.reply()
+        send_all(sock, self.encrypt(reply))
+        self.encryptor, self.decryptor = ciphers.session(DES_KEY, hs.client_share, False)
+        logging.info("Server warm connection keyed, waiting for address")
+        sock.settimeout(timeouts.idle)          # the client keeps these in its pool
+        self.server.slot(self.request).established()
+        try:
+            frames = read_frames(sock, self.DES_decrypt)
+        except socket.timeout:
+            timeouts.fired('idle')
+            logging.info("warm connection idle, closing")
+            return
+        try:
+            remote = self.connect_remote(*parse_addr(frames.get(F_ADDR, '')), owner=frames.get(F_OWNER))
+        except (HandshakeError, socket.error), e:
+            # nobody to tell: the client is already sending, like the legacy protocol
+            logging.warn(e)
+            return
+        self.handle_tcp(sock, remote, frames.get(F_DATA, ''))
 
 
 def readConfig():
@@ -191,30 +291,70 @@ def readConfig():
     SERVER = config['server']
     PORT = config['server_port']
     KEY = config['password']
-    optlist, args = getopt.getopt(sys.argv[1:], 'p:k:')
+    optlist, args = getopt.getopt(sys.argv[1:], 'p:k:', ['workers=', 'cipher='])
     for key, value in optlist:
         if key == '-p':
             PORT = int(value)
         elif key == '-k':
             KEY = value
+        elif key == '--workers':
+            config['workers'] = int(value)
+        elif key == '--cipher':
+            config['cipher'] = value
 
-    return SERVER, PORT, KEY
+    return SERVER, PORT, KEY, config
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(__file__) or '.')
 
     print 'naivesocks v0.1'
-    SERVER, PORT, KEY = readConfig()
+    SERVER, PORT, KEY, config = readConfig()
+    ThreadingTCPServer.request_queue_size = config.get('accept_backlog', 128)
 
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S', filemode='a+')
 
-    encrypt_table = ''.join(get_table(KEY))
-    decrypt_table = string.maketrans(encrypt_table, string.maketrans('', ''))
+    try:
+        # each worker builds its own caches below, after the fork
+        if config.get('workers', 1) > 1:
+            config.setdefault('ticket_secret', os.urandom(32))     # tickets resume on any worker
+        listen = lambda reuse_port=False: bind_server(ThreadingTCPServer, ('', PORT), Socks5Server, reuse_port)
+        server, reporter = supervise(config.get('workers', 1), listen, config,
+                                     config.get('server_stats_port', 0), 'easysocks_server')
+    except socket.error, e:
+        logging.error(e)
+        sys.exit(1)
+
+    tables = load_tables(config)
+    encrypt_table, decrypt_table = tables.get(KEY)
+    ciphers = load_cipher(config, tables)
+    load_primes(config)
+    keys = start_key_pool(config)
+    tickets = load_tickets(config)
+    relay = load_relay(config)
+    timeouts = load_timeouts(config)
+    resolver = load_resolver(config)
+    connector = load_connector(config, resolver)
+    upstreams = load_upstreams(config)
+    metrics = Metrics()
+    shaper = load_shaper(config)
+    admission = load_admission(config)
+    MUX_WINDOW = config.get('mux_window', 256 * 1024)
 
     try:
-        server = ThreadingTCPServer(('', PORT), Socks5Server)
-        logging.info("starting server at port %d ..." % PORT)
+        server = server or listen()
+        server.admission = admission
+        server.reject_reply = reject(STATUS_BUSY).translate(encrypt_table)     # what a v2 client reads first
+        collect = lambda: {'relay': relay.stats(), 'tables': tables.stats(), 'keys': keys.stats(),
+                           'tickets': tickets.stats(), 'timeouts': timeouts.stats(),
+                           'resolver': resolver.stats(), 'connector': connector.stats(),
+                           'upstreams': upstreams.stats(), 'stages': metrics.stats(),
+                           'shaping': shaper.stats(), 'admission': admission.stats() if admission else {}}
+        if reporter:
+            reporter.start(collect)
+        elif config.get('server_stats_port'):
+            StatsServer(config['server_stats_port'], collect, 'easysocks_server').start()
+        logging.info("starting server at port %d (pid %d) ..." % (PORT, os.getpid()))
         server.serve_forever()
     except socket.error, e:
         logging.error(e)
@@ -0,0 +1,144 @@
+import sys
+import time
+from collections import OrderedDict
+
+# Token bucket bandwidth shaping for relayed tunnels in three levels,
+# global -> user -> tunnel, each with a bucket per direction. A bucket
+# holds up to burst seconds of its rate. A read may take no more than the
+# emptiest bucket on its path holds and is charged to all of them; a flow
+# whose path is empty is not read at all (relay.py drops its EPOLLIN until
+# the tokens are due), so an over-quota sender is held back by TCP rather
+# than by our buffers. Rates are bytes per second per direction, 0 for no
+# limit; "shape_users" overrides the per-user rate by name. Every user's
+# bytes are counted whether or not anything is limited. A user with no open
+# tunnel keeps its counts and buckets while it is among the last
+# shape_idle_users such users; older ones are dropped, so a server that
+# sees a new client address per tunnel does not grow without bound.
+#
+# Not locked: the relay loops are greenlets in local.py and server.py.
+#
+#   python shaping.py [rate]      a shaped tunnel's rate against its limit
+UNLIMITED = sys.maxsize
+
+
+class Bucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, rate * burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def fill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        return self.tokens
+
+    def due(self, n):
+        """ Seconds until n tokens are in """
+        return max(0.0, (n - self.tokens) / self.rate)
+
+
+class Path(object):
+    """ One direction of one tunnel: its buckets, tunnel to global, and its user's byte counts """
+    __slots__ = ('buckets', 'smallest', 'account', 'side', 'release')
+
+    def __init__(self, buckets, account, side, release=None):
+        self.buckets = buckets
+        self.smallest = min([b.burst for b in buckets] or [UNLIMITED])
+        self.account = account          # [bytes up, bytes down] of the user
+        self.side = side
+        self.release = release          # called once, when the tunnel closes
+
+    def allowance(self, now, least):
+        """ Bytes that may be read now: 0 until least of them (or a full bucket) are in """
+        tokens = min([b.fill(now) for b in self.buckets] or [UNLIMITED])
+        return int(tokens) if tokens >= min(least, self.smallest) else 0
+
+    def delay(self, least):
+        """ Seconds until allowance(least) is due """
+        n = min(least, self.smallest)
+        return max(b.due(n) for b in self.buckets)
+
+    def take(self, n):
+        for bucket in self.buckets:
+            bucket.tokens -= n
+        self.account[self.side] += n
+
+    def close(self):
+        release, self.release = self.release, None
+        if release is not None:
+            release()
+
+
+class Shaper(object):
+
+    def __init__(self, global_rate=0, user_rate=0, tunnel_rate=0, burst=0.5, user_rates=None, idle_users=1024):
+        self.user_rate = user_rate
+        self.tunnel_rate = tunnel_rate
+        self.burst = burst
+        self.user_rates = user_rates or {}
+        self.top = self._pair(global_rate)
+        self.users = {}                 # user -> (up, down) buckets
+        self.accounts = {}              # user -> [bytes up, bytes down]
+        self.open = {}                  # user -> open paths (two per tunnel)
+        self.idle = OrderedDict()       # users without an open tunnel, oldest first
+        self.idle_users = idle_users
+
+    def _pair(self, rate):
+        return (Bucket(rate, self.burst), Bucket(rate, self.burst)) if rate else (None, None)
+
+    def paths(self, user):
+        """ (up, down) Paths for a new tunnel of user, for Relay.add """
+        if user not in self.users:
+            self.users[user] = self._pair(self.user_rates.get(user, self.user_rate))
+            self.accounts[user] = [0, 0]
+        self.idle.pop(user, None)
+        self.open[user] = self.open.get(user, 0) + 2
+        tunnel = self._pair(self.tunnel_rate)
+        return tuple(Path([b for b in (tunnel[side], self.users[user][side], self.top[side]) if b is not None],
+                          self.accounts[user], side, lambda: self._closed(user)) for side in (0, 1))
+
+    def _closed(self, user):
+        self.open[user] -= 1
+        if self.open[user]:
+            return
+        del self.open[user]
+        self.idle[user] = True
+        while len(self.idle) > self.idle_users:
+            oldest = self.idle.popitem(last=False)[0]
+            del self.users[oldest]
+            del self.accounts[oldest]
+
+    def stats(self):
+        return {'users': dict((user, {'bytes_up': up, 'bytes_down': down})
+                              for user, (up, down) in self.accounts.items())}
+
+
+def load_shaper(config):
+    return Shaper(config.get('shape_global', 0), config.get('shape_user', 0), config.get('shape_tunnel', 0),
+                  config.get('shape_burst', 0.5), config.get('shape_users'), config.get('shape_idle_users', 1024))
+
+
+if __name__ == '__main__':
+    import threading
+    from relay import Relay, _bulk
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else 8 << 20
+    for label, shaper, tunnels in [('tunnel limit', Shaper(tunnel_rate=rate), 1),
+                                   ('user limit, 4 tunnels', Shaper(user_rate=rate), 4),
+                                   ('global limit, 4 users', Shaper(global_rate=rate), 4)]:
+        relay = Relay()
+        total = rate * 4 // tunnels >> 16 << 16    # whole 64K chunks, ~4 s at the limit plus the first burst
+        users = ['user%d' % i if 'users' in label else 'user' for i in range(tunnels)]
+        start = time.time()
+        threads = [threading.Thread(target=_bulk, args=(lambda a, b, u=u: relay.add(a, b, shape=shaper.paths(u)),
+                                                         total)) for u in users]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        print('%-22s %7.2f MB/s of %.2f, deferred %d, %s' % (label, total * tunnels / elapsed / 1e6, rate / 1e6,
+                                                          relay.stats()['deferred'], shaper.stats()['users']))
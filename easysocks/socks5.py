@@ -0,0 +1,229 @@
+import sys
+import time
+import socket
+import struct
+from collections import namedtuple
+
+# Incremental parser for the client side of a SOCKS5 handshake: greeting,
+# RFC 1929 username/password auth, then the request. Bytes go into one
+# buffer made per connection (fill() receives straight into it); next()
+# returns the message for the current state once it is complete, None while
+# more is needed, and moves on to the next state. Clients may pipeline the
+# whole handshake, even data after the request, in one segment: whatever
+# follows the request is left for rest(). Shared by local.py (python 2) and
+# socks/server.py (python 3).
+#
+#   python socks5.py [N]      parse rate, whole and byte by byte
+VERSION = 5
+AUTH_VERSION = 1
+BUFFER_SIZE = 4096              # the longest handshake is about 1K
+
+Greeting = namedtuple('Greeting', 'methods')                   # methods: bytearray, `2 in methods` works
+Auth = namedtuple('Auth', 'username password')
+Request = namedtuple('Request', 'cmd atyp host port addr')     # addr: ATYP [len] address port, as sent
+_new = tuple.__new__                    # Message(...) without the python level __new__ namedtuple adds
+
+GREETING, AUTH, REQUEST, DONE = range(4)
+
+
+class Socks5Error(socket.error):
+    pass
+
+
+# from memoryview slices, one copy each
+if bytes is str:
+    _text = _host = memoryview.tobytes  # python 2: plain str
+else:
+    _text = lambda view: str(view, 'utf-8')
+    _host = lambda view: str(view, 'ascii', 'replace')
+
+
+class Socks5Parser(object):
+
+    def __init__(self, auth=True, size=BUFFER_SIZE):
+        self.state = GREETING
+        self.auth = auth                # expect RFC 1929 auth after the greeting
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0       # unparsed bytes are buf[start:end]
+
+    def feed(self, data):
+        self._room(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def fill(self, sock):
+        """ One recv into the buffer; returns the byte count, 0 at EOF """
+        if self.end == len(self.buf):
+            self._room(1)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def _room(self, n):
+        if len(self.buf) - self.end >= n:
+            return
+        if self.start:                  # move the unparsed tail to the front
+            self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        if len(self.buf) - self.end < n:
+            raise Socks5Error('handshake too long')
+
+    def next(self):
+        """ The next complete message, None until enough bytes are in """
+        return self._steps[self.state](self)
+
+    def rest(self):
+        """ Bytes received after the request (pipelined application data) """
+        data = bytes(self.buf[self.start:self.end])
+        self.start = self.end = 0
+        return data
+
+    def _greeting(self):
+        buf, i = self.buf, self.start
+        if self.end - i < 2:
+            return None
+        if buf[i] != VERSION:
+            raise Socks5Error('not socks5 (version %d)' % buf[i])
+        if not buf[i + 1]:
+            raise Socks5Error('no auth methods offered')
+        end = i + 2 + buf[i + 1]
+        if self.end < end:
+            return None
+        self.start = end
+        self.state = AUTH if self.auth else REQUEST
+        return _new(Greeting, (buf[i + 2:end],))
+
+    def _auth(self):
+        buf, i = self.buf, self.start
+        if self.end - i < 2:
+            return None
+        if buf[i] != AUTH_VERSION:
+            raise Socks5Error('bad auth version %d' % buf[i])
+        p = i + 2 + buf[i + 1]              # password length
+        if self.end <= p:
+            return None
+        end = p + 1 + buf[p]
+        if self.end < end:
+            return None
+        self.start = end
+        self.state = REQUEST
+        view = self.view
+        try:
+            return _new(Auth, (_text(view[i + 2:p]), _text(view[p + 1:end])))
+        except UnicodeDecodeError:
+            raise Socks5Error('credentials not utf-8')
+
+    def _request(self):
+        buf, i = self.buf, self.start
+        if self.end - i < 5:
+            return None
+        if buf[i] != VERSION:
+            raise Socks5Error('not socks5 (version %d)' % buf[i])
+        atyp = buf[i + 3]
+        if atyp == 1:
+            p = i + 8
+        elif atyp == 4:
+            p = i + 20
+        elif atyp == 3:
+            p = i + 5 + buf[i + 4]
+        else:
+            raise Socks5Error('address type %d not supported' % atyp)
+        end = p + 2
+        if self.end < end:
+            return None
+        self.start = end
+        self.state = DONE
+        view = self.view
+        if atyp == 1:
+            host = socket.inet_ntoa(view[i + 4:p].tobytes())
+        elif atyp == 4:
+            host = socket.inet_ntop(socket.AF_INET6, view[i + 4:p].tobytes())
+        else:
+            host = _host(view[i + 5:p])
+        return _new(Request, (buf[i + 1], atyp, host, buf[p] << 8 | buf[p + 1], view[i + 3:end].tobytes()))
+
+    def _done(self):
+        raise Socks5Error('handshake already parsed')
+
+    _steps = (_greeting, _auth, _request, _done)      # by state, as plain functions: no bound method per call
+
+
+def read_message(sock, parser):
+    """ Receive until parser has its next message """
+    while True:
+        if parser.end > parser.start or parser.state == DONE:      # with nothing buffered, recv first
+            message = parser._steps[parser.state](parser)     # next(), one call less per message
+            if message is not None:
+                return message
+        if not parser.fill(sock):
+            raise Socks5Error('connection closed during handshake')
+
+
+def _parse_whole(data):
+    parser = Socks5Parser()
+    parser.feed(data)
+    return parser.next(), parser.next(), parser.next()
+
+
+def _parse_bytewise(data):
+    parser = Socks5Parser()
+    messages = []
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+        message = parser.next()
+        if message is not None:
+            messages.append(message)
+    return messages
+
+
+def _recv_parser(sock):
+    parser = Socks5Parser()
+    return read_message(sock, parser), read_message(sock, parser), read_message(sock, parser)
+
+
+def _recv_fields(sock):
+    """ The old way, a recv per field, for comparison """
+    recv = sock.recv
+    version, nmethods = struct.unpack('!BB', recv(2))
+    methods = [ord(recv(1)) for i in range(nmethods)]
+    version = ord(recv(1))
+    username = recv(ord(recv(1)))
+    password = recv(ord(recv(1)))
+    version, cmd, rsv, atyp = struct.unpack('!BBBB', recv(4))
+    host = recv(ord(recv(1)))
+    port = struct.unpack('!H', recv(2))[0]
+    return methods, username, password, host, port
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    host = b'www.example.com'
+    request = b'\x05\x01\x00\x03' + struct.pack('!B', len(host)) + host + struct.pack('!H', 443)
+    handshake = b'\x05\x02\x00\x02' + b'\x01\x08username\x08password' + request
+    early = b'GET / HTTP/1.1\r\n\r\n'
+
+    parser = Socks5Parser()
+    parser.feed(handshake + early)
+    greeting, auth, req = parser.next(), parser.next(), parser.next()
+    assert set(greeting.methods) == set([0, 2]) and auth == ('username', 'password'), (greeting, auth)
+    assert req.cmd == 1 and req.port == 443 and req.addr == request[3:], req
+    assert parser.rest() == early
+    assert _parse_bytewise(handshake) == [greeting, auth, req]
+
+    start = time.time()
+    for i in range(n):
+        _parse_whole(handshake)
+    print('%-24s %9.0f handshakes/s' % ('parser, in memory', n / (time.time() - start)))
+    start = time.time()
+    for i in range(n // 10):
+        _parse_bytewise(handshake)
+    print('%-24s %9.0f handshakes/s' % ('parser, byte by byte', n // 10 / (time.time() - start)))
+    a, b = socket.socketpair()
+    for name, parse in [('parser, socket', _recv_parser), ('recv per field, socket', _recv_fields)]:
+        start = time.time()
+        for i in range(n):
+            a.sendall(handshake)
+            parse(b)
+        print('%-24s %9.0f handshakes/s' % (name, n / (time.time() - start)))
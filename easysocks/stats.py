@@ -0,0 +1,193 @@
+import re
+import time
+import socket
+import bisect
+import logging
+import numbers
+import threading
+
+# Latency bounds in milliseconds, roughly 1-2-5 steps; the last bucket is
+# everything slower than the last bound.
+LATENCY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+SIZE_BOUNDS = tuple(1 << n for n in range(10, 32, 2))      # 1K .. 1G bytes
+DURATION_BOUNDS = (0.1, 1, 10, 60, 300, 1800, 3600)        # seconds
+
+
+class Histogram(object):
+    """
+    Fixed-bucket counts of observed values, cheap enough for every connect.
+    stats() is ints and lists so workers' histograms add up with
+    merge_stats (the quantiles, floats, are averaged: a rough figure);
+    'le' carries the bounds for prometheus().
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def observe_since(self, start, now):
+        """ Seconds elapsed, recorded in milliseconds """
+        self.observe((now - start) * 1000.0)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-th value (None when empty or past the last bound) """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return float(bound)
+        return None
+
+    def stats(self):
+        return {'count': self.count, 'sum': int(self.total), 'buckets': list(self.counts),
+                'le': ','.join(str(b) for b in self.bounds),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Metrics(object):
+    """
+    Named counters and histograms for a proxy's stages, made on first use.
+    Not locked: a lost increment between greenlets is not worth a lock on
+    the hot path.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=LATENCY_BOUNDS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+    def time(self, name, start, now=None):
+        """ Milliseconds since start into histogram name; returns now """
+        now = now or time.time()
+        self.observe(name, (now - start) * 1000.0)
+        return now
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update((name, h.stats()) for name, h in self.histograms.items())
+        return stats
+
+
+def count_tunnel(metrics, tunnel):
+    """ A finished relay tunnel's bytes and lifetime """
+    stats = tunnel.stats()
+    metrics.count('tunnels')
+    metrics.count('bytes_up', stats['up'])
+    metrics.count('bytes_down', stats['down'])
+    metrics.observe('tunnel_up_bytes', stats['up'], SIZE_BOUNDS)
+    metrics.observe('tunnel_down_bytes', stats['down'], SIZE_BOUNDS)
+    metrics.observe('tunnel_seconds', stats['age'], DURATION_BOUNDS)
+
+
+_NAME = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+def prometheus(stats, prefix):
+    """
+    Prometheus text format for a stats dict: numbers become samples named
+    by their path, histogram dicts _bucket/_sum/_count series, keys that are
+    not names (addresses, say) and the keys of a "users" dict an id label.
+    Strings and lists are skipped.
+    """
+    lines = []
+    _render(lines, set(), prefix, (), stats)
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, extra=()):
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _render(lines, typed, name, labels, value, ids=False):
+    if isinstance(value, dict):
+        if 'buckets' in value and 'le' in value:
+            return _histogram(lines, typed, name, labels, value)
+        for key, sub in sorted(value.items(), key=lambda item: str(item[0])):
+            key = str(key)
+            if _NAME.match(key) and not ids:
+                _render(lines, typed, name + '_' + key, labels, sub, key == 'users')
+            else:
+                _render(lines, typed, name, labels + (('id', key),), sub)
+    elif isinstance(value, bool):
+        lines.append('%s%s %d' % (name, _labels(labels), value))
+    elif isinstance(value, numbers.Number):
+        lines.append('%s%s %r' % (name, _labels(labels), value))
+
+
+def _histogram(lines, typed, name, labels, value):
+    if name not in typed:
+        typed.add(name)
+        lines.append('# TYPE %s histogram' % name)
+    total = 0
+    for bound, n in zip(value['le'].split(',') + ['+Inf'], value['buckets']):
+        total += n
+        lines.append('%s_bucket%s %d' % (name, _labels(labels, (('le', bound),)), total))
+    lines.append('%s_sum%s %r' % (name, _labels(labels), value['sum']))
+    lines.append('%s_count%s %d' % (name, _labels(labels), value['count']))
+
+
+class StatsServer(object):
+    """
+    Answers any HTTP request on host:port with prometheus(collect(), prefix).
+    start() serves from a thread (a greenlet once gevent has patched
+    threading); bind() alone leaves accepting to the caller's own loop.
+    """
+
+    def __init__(self, port, collect, prefix, host='127.0.0.1'):
+        self.address = (host, port)
+        self.collect = collect
+        self.prefix = prefix
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(16)
+        logging.info("stats on http://%s:%d/metrics" % self.address)
+        return self
+
+    def start(self):
+        self.bind()
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _serve(self):
+        while True:
+            conn, peer = self.sock.accept()
+            self.answer(conn)
+
+    def answer(self, conn):
+        try:
+            conn.settimeout(5)
+            conn.recv(4096)                     # the request itself does not matter
+            body = prometheus(self.collect(), self.prefix).encode()
+            conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        except socket.error as e:
+            logging.warn("stats: %s" % e)
+        finally:
+            conn.close()
@@ -0,0 +1,140 @@
+import sys
+import struct
+import string
+import hashlib
+import threading
+import logging
+import time
+from collections import OrderedDict
+
+RECORD_SIZE = 16 + 256          # md5 digest + table
+
+
+def _get_table_cmp(key):
+    """ Reference implementation (comparator sort), kept for verification """
+    m = hashlib.md5()
+    m.update(key)
+    s = m.digest()
+    (a, b) = struct.unpack('<QQ', s)
+    table = [c for c in string.maketrans('', '')]
+    for i in xrange(1, 1024):
+        table.sort(lambda x, y: int(a % (ord(x) + i) - a % (ord(y) + i)))
+    return table
+
+
+def _table_from_digest(s):
+    (a, b) = struct.unpack('<QQ', s)
+    # The comparator only ever returns the sign of a % (x + i) - a % (y + i),
+    # so a stable sort on that key gives exactly the same order.
+    table = range(256)
+    for i in xrange(1, 1024):
+        table.sort(key=lambda x: a % (x + i))
+    return ''.join(map(chr, table))
+
+
+def get_table(key):
+    return list(_table_from_digest(hashlib.md5(key).digest()))
+
+
+def make_tables(encrypt_table):
+    decrypt_table = string.maketrans(encrypt_table, string.maketrans('', ''))
+    return encrypt_table, decrypt_table
+
+
+class TableCache(object):
+    """ Bounded LRU of (encrypt_table, decrypt_table), keyed by key digest """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        digest = hashlib.md5(key).digest()
+        with self.lock:
+            tables = self.tables.pop(digest, None)
+            if tables is not None:
+                self.tables[digest] = tables
+                self.hits += 1
+                return tables
+            self.misses += 1
+
+        tables = make_tables(_table_from_digest(digest))
+        self.put(digest, tables)
+        return tables
+
+    def put(self, digest, tables):
+        with self.lock:
+            self.tables.pop(digest, None)
+            self.tables[digest] = tables
+            while len(self.tables) > self.size:
+                self.tables.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.tables), 'hits': self.hits, 'misses': self.misses}
+
+    def load(self, store):
+        count = 0
+        for digest, encrypt_table in store.load():
+            self.put(digest, make_tables(encrypt_table))
+            count += 1
+        return count
+
+
+class TableStore(object):
+    """ Precomputed tables on disk: fixed records of md5(key) + 256 byte table """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if len(data) % RECORD_SIZE != 0:
+            raise Exception('corrupt table store %s' % self.path)
+        for i in xrange(0, len(data), RECORD_SIZE):
+            yield data[i:i+16], data[i+16:i+RECORD_SIZE]
+
+    def save(self, keys):
+        with open(self.path, 'wb') as f:
+            for key in keys:
+                digest = hashlib.md5(key).digest()
+                f.write(digest + _table_from_digest(digest))
+
+
+def load_tables(config):
+    tables = TableCache(config.get('table_cache_size', 1024))
+    path = config.get('table_store')
+    if path:
+        try:
+            logging.info("loaded %d tables from %s" % (tables.load(TableStore(path)), path))
+        except IOError, e:
+            logging.warn(e)
+    return tables
+
+
+if __name__ == '__main__':
+    # python table.py                      check and time both implementations
+    # python table.py -o <file> key ...    write a precomputed table store
+    if len(sys.argv) > 2 and sys.argv[1] == '-o':
+        TableStore(sys.argv[2]).save(sys.argv[3:])
+        sys.exit(0)
+
+    for key in ['pwd', '12345678', '87654321']:
+        t = time.time()
+        old = _get_table_cmp(key)
+        t_old = time.time() - t
+        t = time.time()
+        new = get_table(key)
+        t_new = time.time() - t
+        assert old == new, 'table mismatch for %s' % key
+        print('%-10s cmp %.1fms  key %.1fms' % (key, t_old * 1000, t_new * 1000))
+
+    cache = TableCache(2)
+    cache.get('12345678')
+    t = time.time()
+    for i in xrange(1000):
+        cache.get('12345678')
+    print('cached lookup %.1fus' % ((time.time() - t) * 1000))
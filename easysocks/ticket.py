@@ -0,0 +1,145 @@
+import os
+import hmac
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+TICKET_SIZE = 16
+BINDER_SIZE = 16
+NONCE_SIZE = 8
+
+
+def binder(key, share):
+    """ Proves the client holds the key a ticket was issued for """
+    return hmac.new(key, share, hashlib.md5).digest()
+
+
+def _keystream(key, nonce, n):
+    blocks = [hmac.new(key, nonce + struct.pack('!I', i), hashlib.sha256).digest()
+              for i in range((n + 31) // 32)]
+    return ''.join(blocks)[:n]
+
+
+def _xor(data, stream):
+    return ''.join(chr(ord(a) ^ ord(b)) for a, b in zip(data, stream))
+
+
+def seal(secret, expires, value):
+    """
+    A self-contained ticket: expiry and session key encrypted and MACed
+    under secret, so any process holding the secret can resume it.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    enc = hmac.new(secret, 'enc', hashlib.sha256).digest()
+    mac = hmac.new(secret, 'mac', hashlib.sha256).digest()
+    plain = struct.pack('!I', int(expires)) + value
+    body = nonce + _xor(plain, _keystream(enc, nonce, len(plain)))
+    return body + hmac.new(mac, body, hashlib.sha256).digest()[:16]
+
+
+def unseal(secret, ticket):
+    """ (expires, value), or None when the ticket was not sealed with secret """
+    if len(ticket) < NONCE_SIZE + 4 + 16:
+        return None
+    body, tag = ticket[:-16], ticket[-16:]
+    mac = hmac.new(secret, 'mac', hashlib.sha256).digest()
+    if not hmac.compare_digest(tag, hmac.new(mac, body, hashlib.sha256).digest()[:16]):
+        return None
+    nonce, data = body[:NONCE_SIZE], body[NONCE_SIZE:]
+    enc = hmac.new(secret, 'enc', hashlib.sha256).digest()
+    plain = _xor(data, _keystream(enc, nonce, len(data)))
+    return struct.unpack('!I', plain[:4])[0], plain[4:]
+
+
+class TicketCache(object):
+    """
+    LRU of session tickets with a TTL. The server maps ticket -> session key,
+    the client maps (server, port) -> (ticket, session key). A server given
+    a secret (shared by all --workers) issues sealed tickets instead and
+    keeps nothing.
+    """
+
+    def __init__(self, size=4096, ttl=3600, secret=None):
+        self.size = size
+        self.ttl = ttl
+        self.secret = secret
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.resumed = 0                # client side: tickets the server accepted
+        self.rejected = 0               # ... and ones it no longer knew
+
+    def get(self, key):
+        if self.secret is not None:
+            return self._unseal(key)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + (ttl or self.ttl), value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def issue(self, session_key):
+        if self.secret is not None:
+            return seal(self.secret, time.time() + self.ttl, session_key)
+        ticket = os.urandom(TICKET_SIZE)
+        self.put(ticket, session_key)
+        return ticket
+
+    def _unseal(self, ticket):
+        opened = unseal(self.secret, ticket)
+        if opened is None:
+            self.misses += 1
+            return None
+        expires, value = opened
+        if expires < time.time():
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def record(self, key, accepted):
+        if accepted:
+            self.resumed += 1
+        else:
+            self.rejected += 1
+            self.discard(key)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'expired': self.expired, 'evicted': self.evicted, 'hit_rate': self.hit_rate(),
+                'resumed': self.resumed, 'rejected': self.rejected}
+
+
+def load_tickets(config):
+    return TicketCache(config.get('ticket_cache_size', 4096), config.get('ticket_ttl', 3600),
+                       config.get('ticket_secret'))
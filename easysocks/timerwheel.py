@@ -0,0 +1,69 @@
+import time
+
+
+class TimerWheel(object):
+    """
+    Hashed timing wheel: schedule() is an append, advance() looks only at
+    the slots whose tick has passed and returns everything due in one list.
+    Items are not cancelled; whoever gets them back checks if they still
+    matter (e.g. a tunnel that saw traffic is simply scheduled again).
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.current = int((now or time.time()) / tick)
+        self.count = 0
+
+    def schedule(self, item, deadline):
+        tick = max(int(deadline / self.tick) + 1, self.current + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+
+    def advance(self, now=None):
+        target = int((now or time.time()) / self.tick)
+        due = []
+        for step in range(1, min(target - self.current, len(self.slots)) + 1):
+            i = (self.current + step) % len(self.slots)
+            slot = self.slots[i]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[0] <= target:
+                    due.append(entry[1])
+                else:
+                    keep.append(entry)
+            self.slots[i] = keep
+        self.current = max(self.current, target)
+        self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
+
+
+class Timeouts(object):
+    """
+    Handshake, connect and idle limits in seconds (0: none), with a count
+    of how often each one fired. Idle tunnels in the relay are counted
+    there; 'idle' here is connections that timed out waiting outside it.
+    """
+
+    def __init__(self, handshake=30, connect=10, idle=600):
+        self.handshake = handshake or None
+        self.connect = connect or None
+        self.idle = idle or None
+        self.expired = {'handshake': 0, 'connect': 0, 'idle': 0}
+
+    def fired(self, phase):
+        self.expired[phase] += 1
+
+    def stats(self):
+        return dict(self.expired)
+
+
+def load_timeouts(config):
+    """ config['timeout'] is the idle limit for relayed tunnels """
+    return Timeouts(config.get('handshake_timeout', 30), config.get('connect_timeout', 10),
+                    config.get('timeout', 600))
@@ -0,0 +1,290 @@
+import time
+import errno
+import socket
+import threading
+from collections import deque, OrderedDict
+
+# Keep-alive reuse of origin connections. For destinations on the listed
+# ports (plain HTTP) the relay shows every tunnel's upstream bytes to an
+# HttpTracker, which follows request and response framing (Content-Length,
+# chunked, HEAD, 1xx/204/304) without buffering bodies. When the client
+# side closes while the upstream connection sits between responses and
+# both ends allowed keep-alive, the relay parks the upstream socket here
+# instead of closing it, and the next CONNECT to the same (host, port) by
+# the same owner takes it after a MSG_PEEK probe shows it is still open
+# and silent. The owner is the client's address plus the tag its local.py
+# sends for the SOCKS user (F_OWNER): a connection authenticated per
+# connection (NTLM, Negotiate) must never pass to another user, so tunnels
+# without a tag (v1, mux streams) are not pooled at all.
+# Anything the tracker does not understand (Upgrade, CONNECT, bodies ended
+# by close, chunked requests, oversized heads) makes that connection
+# unreusable; it is then closed as before.
+MAX_HEAD = 16384
+MAX_LINE = 4096
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def is_alive(sock):
+    """ An idle keep-alive connection has nothing to read: EOF or stray bytes mean drop it """
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except socket.error as e:
+        return e.args[0] in _RETRY      # nothing to read: still open and silent
+    return False                        # '' is EOF, anything else stray bytes
+
+
+def _wrap(raw):
+    """ A socket.socket (gevent's, when patched) owning raw's descriptor """
+    if hasattr(raw, 'detach'):
+        return socket.socket(raw.family, raw.type, 0, raw.detach())
+    return socket.socket(_sock=raw)
+
+
+def _parse_head(head):
+    """ (first line split in three, {lowercase header: value}) """
+    lines = head.split(b'\r\n')
+    first = lines[0].split(b' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise ValueError('bad header line')
+        name = name.strip().lower()
+        value = value.strip().lower()
+        headers[name] = headers[name] + b',' + value if name in headers else value
+    return first, headers
+
+
+def _keep_alive(version, headers):
+    connection = headers.get(b'connection', b'')
+    if version == b'HTTP/1.1':
+        return b'close' not in connection
+    return version == b'HTTP/1.0' and b'keep-alive' in connection
+
+
+class HttpTracker(object):
+    """
+    Relay watch for one tunnel (see Tunnel.watch): to_b/from_b see the
+    plaintext going to and coming from the origin, park() is offered the
+    origin socket when the tunnel ends with it still open.
+    """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.reusable = True
+        self.methods = deque()          # requests sent, awaiting their response
+        self.request_head = b''
+        self.request_body = 0
+        self.response_head = b''
+        self.response_body = 0
+        self.chunk = None               # chunked body state: 'size', 'data', 'crlf' or 'trailer'
+        self.line = b''
+
+    @property
+    def idle(self):
+        return (self.reusable and not self.methods and not self.request_head and not self.request_body
+                and not self.response_head and not self.response_body and self.chunk is None)
+
+    def park(self, sock):
+        if not self.idle:
+            self.pool.unreusable += 1
+            return False
+        return self.pool.put(self.key, sock)
+
+    def to_b(self, data):
+        try:
+            i = 0
+            while i < len(data) and self.reusable:
+                if self.request_body:
+                    step = min(self.request_body, len(data) - i)
+                    self.request_body -= step
+                    i += step
+                    continue
+                head, i, self.request_head = self._head(self.request_head, data, i)
+                if head is not None:
+                    self._request(head)
+        except (ValueError, IndexError):
+            self.reusable = False
+
+    def from_b(self, data):
+        try:
+            i = 0
+            while i < len(data) and self.reusable:
+                if self.chunk is not None:
+                    i = self._chunked(data, i)
+                    continue
+                if self.response_body:
+                    step = min(self.response_body, len(data) - i)
+                    self.response_body -= step
+                    i += step
+                    continue
+                head, i, self.response_head = self._head(self.response_head, data, i)
+                if head is not None:
+                    self._response(head)
+        except (ValueError, IndexError):
+            self.reusable = False
+
+    def _head(self, partial, data, i):
+        """ (complete head or None, next index, partial head kept for the next call) """
+        window = partial + data[i:i + MAX_HEAD].tobytes()
+        end = window.find(b'\r\n\r\n')
+        if end < 0:
+            if len(window) >= MAX_HEAD:
+                self.reusable = False
+            return None, len(data), window
+        return window[:end], i + end + 4 - len(partial), b''
+
+    def _request(self, head):
+        (method, target, version), headers = _parse_head(head)
+        if method == b'CONNECT' or b'upgrade' in headers or b'transfer-encoding' in headers \
+                or not _keep_alive(version, headers):
+            self.reusable = False
+            return
+        self.methods.append(method)
+        self.request_body = int(headers.get(b'content-length', 0))
+
+    def _response(self, head):
+        (version, status, reason), headers = _parse_head(head)
+        status = int(status)
+        if status == 101 or not self.methods:
+            self.reusable = False
+            return
+        if status < 200:
+            return                      # interim (100 Continue): the real response follows
+        method = self.methods.popleft()
+        if not _keep_alive(version, headers):
+            self.reusable = False
+        elif method == b'HEAD' or status in (204, 304):
+            pass
+        elif b'chunked' in headers.get(b'transfer-encoding', b''):
+            self.chunk = 'size'
+        elif b'content-length' in headers:
+            self.response_body = int(headers[b'content-length'])
+        else:
+            self.reusable = False       # the body ends when the origin closes
+
+    def _chunked(self, data, i):
+        if self.chunk == 'data':
+            step = min(self.response_body, len(data) - i)
+            self.response_body -= step
+            if not self.response_body:
+                self.chunk, self.line = 'crlf', b''
+            return i + step
+        line, i = self._line(data, i)
+        if line is None:
+            return i
+        if self.chunk == 'crlf':
+            self.chunk = 'size'
+        elif self.chunk == 'size':
+            size = int(line.split(b';')[0], 16)
+            if size:
+                self.chunk, self.response_body = 'data', size
+            else:
+                self.chunk = 'trailer'
+        elif not line.strip():
+            self.chunk = None           # empty line after the trailers: body done
+        return i
+
+    def _line(self, data, i):
+        window = data[i:i + MAX_LINE].tobytes()
+        end = window.find(b'\n')
+        if end < 0:
+            self.line += window
+            if len(self.line) > MAX_LINE:
+                self.reusable = False
+            return None, i + len(window)
+        line, self.line = self.line + window[:end + 1], b''
+        return line, i + end + 1
+
+
+class UpstreamPool(object):
+    """
+    Idle origin connections by (client, owner, host, port): newest first per key, at most
+    per_host per key and size in all, each for at most `idle` seconds.
+    """
+
+    def __init__(self, size=0, per_host=4, idle=15, ports=(80,)):
+        self.size = size
+        self.per_host = per_host
+        self.idle = idle
+        self.ports = set(ports)
+        self.parked = OrderedDict()     # raw socket -> (key, since), oldest first
+        self.by_key = {}                # key -> [raw socket], newest last
+        self.lock = threading.Lock()
+        self.reused = 0
+        self.kept = 0
+        self.dead = 0
+        self.expired = 0
+        self.evicted = 0
+        self.unreusable = 0
+
+    def tracker(self, key):
+        """ A watch for a tunnel to key, or None when its connection is not to be kept """
+        if not self.size or key is None or key[-1] not in self.ports:
+            return None
+        return HttpTracker(self, key)
+
+    def get(self, key):
+        """ A live idle connection to key as a socket.socket, or None """
+        if not self.size or key is None:
+            return None
+        while True:
+            with self.lock:
+                self._expire()
+                socks = self.by_key.get(key)
+                if not socks:
+                    return None
+                raw = self._take(socks.pop())
+            if is_alive(raw):
+                self.reused += 1
+                return _wrap(raw)
+            self.dead += 1
+            raw.close()
+
+    def put(self, key, raw):
+        """ Called by the relay with its own (nonblocking) socket; False when not kept """
+        with self.lock:
+            self._expire()
+            socks = self.by_key.get(key, [])
+            if len(socks) >= self.per_host:
+                self._take(socks.pop(0)).close()
+                self.evicted += 1
+            while self.parked and len(self.parked) >= self.size:
+                oldest = next(iter(self.parked))
+                self.by_key[self.parked[oldest][0]].remove(oldest)
+                self._take(oldest).close()
+                self.evicted += 1
+            self.parked[raw] = (key, time.time())
+            self.by_key.setdefault(key, []).append(raw)
+            self.kept += 1
+        return True
+
+    def _take(self, raw):
+        key, since = self.parked.pop(raw)
+        if not self.by_key.get(key):
+            self.by_key.pop(key, None)
+        return raw
+
+    def _expire(self):
+        deadline = time.time() - self.idle
+        while self.parked:
+            oldest = next(iter(self.parked))
+            key, since = self.parked[oldest]
+            if since > deadline:
+                break
+            self.by_key[key].remove(oldest)
+            self._take(oldest).close()
+            self.expired += 1
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+        return {'idle': len(self.parked), 'kept': self.kept, 'reused': self.reused, 'dead': self.dead,
+                'expired': self.expired, 'evicted': self.evicted, 'unreusable': self.unreusable}
+
+
+def load_upstreams(config):
+    """ upstream_pool_size 0 (the default) turns reuse off """
+    return UpstreamPool(config.get('upstream_pool_size', 0), config.get('upstream_per_host', 4),
+                        config.get('upstream_idle', 15), config.get('upstream_ports', [80]))
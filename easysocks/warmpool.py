@@ -0,0 +1,108 @@
+import time
+import socket
+import select
+import logging
+from collections import deque
+import gevent
+from gevent.event import Event
+
+
+def is_healthy(sock):
+    """ An idle pooled connection must not be readable: that means EOF, RST or junk """
+    try:
+        r, w, e = select.select([sock], [], [], 0)
+        return sock not in r
+    except (socket.error, select.error, ValueError):
+        return False
+
+
+class WarmPool(object):
+    """
+    Connections to the server that have finished the key exchange and are
+    waiting for a destination address. Keeps at least min_size ready (more,
+    up to max_size, while they are being taken quickly), drops ones idle for
+    longer than `idle` seconds or that fail the health check. After a failed
+    connect it waits interval seconds, doubling up to `backoff` while they
+    keep failing, whatever the misses in between.
+    """
+
+    def __init__(self, connect, min_size=2, max_size=8, idle=60, interval=5, backoff=300):
+        self.connect = connect          # () -> (sock, session key, ...), None when there is nothing to warm
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.idle = idle
+        self.interval = interval
+        self.backoff = backoff
+        self.failures = 0               # connects failed in a row
+        self.retry_at = 0
+        self.ready = deque()            # (created, what connect returned), newest on the right
+        self.wakeup = Event()
+        self.taken = 0                  # since the last refill round
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.failed = 0
+
+    def start(self):
+        self.wakeup.set()
+        gevent.spawn(self._run)
+        return self
+
+    def get(self):
+        """ A ready connection as connect() made it, or None when the caller should connect itself """
+        while self.ready:
+            created, conn = self.ready.pop()
+            if time.time() - created < self.idle and is_healthy(conn[0]):
+                self.hits += 1
+                self.taken += 1
+                if len(self.ready) < self.min_size:
+                    self.wakeup.set()
+                return conn
+            self._drop(conn[0])
+        self.misses += 1
+        self.taken += 1
+        self.wakeup.set()
+        return None
+
+    def _drop(self, sock):
+        self.expired += 1
+        sock.close()
+
+    def _target(self):
+        return min(self.max_size, max(self.min_size, self.taken))
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self._sweep()
+            if time.time() < self.retry_at:
+                continue
+            target = self._target()
+            self.taken = 0
+            while len(self.ready) < target:
+                try:
+                    conn = self.connect()
+                except Exception, e:
+                    self.failed += 1
+                    self.failures += 1
+                    delay = min(self.interval * 2 ** (self.failures - 1), self.backoff)
+                    self.retry_at = time.time() + delay
+                    logging.warn("warm pool connect failed: %s, retrying in %ds" % (e, delay))
+                    break
+                if conn is None:
+                    break
+                self.failures = 0
+                self.ready.append((time.time(), conn))
+
+    def _sweep(self):
+        now = time.time()
+        for entry in list(self.ready):
+            created, conn = entry
+            if now - created >= self.idle or not is_healthy(conn[0]):
+                self.ready.remove(entry)
+                self._drop(conn[0])
+
+    def stats(self):
+        return {'ready': len(self.ready), 'hits': self.hits, 'misses': self.misses,
+                'expired': self.expired, 'failed': self.failed}
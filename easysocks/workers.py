@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import json
+import errno
+import signal
+import select
+import socket
+import logging
+import gevent
+from stats import StatsServer
+
+# --workers N: the process that starts becomes a supervisor. It forks N
+# workers, each a complete proxy with its own tables, keys, tickets and
+# relay loops, and restarts any that die. (server.py seals its tickets with
+# a secret made before the fork, so they resume on any worker.) Workers listen on the same port
+# with SO_REUSEPORT, so the kernel spreads connections over them; without
+# SO_REUSEPORT the supervisor binds once and the workers inherit that
+# socket. Every stats_interval seconds each worker writes its stats as a
+# JSON line to a pipe and the supervisor logs the sum; with a stats port
+# the supervisor also answers scrapes with the latest sum from its loop.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+RESTART_DELAY = 1.0             # a worker that dies young is restarted no faster than this
+
+
+def bind_server(server_class, address, handler, reuse_port=False):
+    server = server_class(address, handler, bind_and_activate=False)
+    try:
+        if reuse_port:
+            server.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
+
+def merge_stats(total, stats, n=1):
+    """
+    Add one of n workers' stats into total: counts are summed, ratios
+    (floats) averaged, lists and tuples summed elementwise.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, {}), value, n)
+        elif isinstance(value, bool):
+            total[key] = value
+        elif isinstance(value, float):
+            total[key] = total.get(key, 0.0) + value / n
+        elif isinstance(value, (int, long)):
+            total[key] = total.get(key, 0) + value
+        elif isinstance(value, (list, tuple)):
+            old = total.get(key) or [0] * len(value)
+            total[key] = [a + b for a, b in zip(old, value)]
+        else:
+            total[key] = value
+    return total
+
+
+class Reporter(object):
+    """ Worker side: sends collect() to the supervisor every interval """
+
+    def __init__(self, fd, interval):
+        self.fd = fd
+        self.interval = interval
+
+    def start(self, collect):
+        gevent.spawn(self._run, collect)
+        return self
+
+    def _run(self, collect):
+        while True:
+            gevent.sleep(self.interval)
+            stats = collect()
+            stats['pid'] = os.getpid()
+            try:
+                os.write(self.fd, json.dumps(stats) + '\n')
+            except OSError, e:
+                if e.errno == errno.EPIPE:
+                    os._exit(0)             # the supervisor is gone
+                raise
+
+
+class Supervisor(object):
+
+    def __init__(self, workers, listen, interval=60, stats_port=0, prefix='easysocks'):
+        self.workers = workers
+        self.listen = listen            # listen(reuse_port) -> bound server
+        self.interval = interval
+        self.stats_port = stats_port
+        self.prefix = prefix
+        self.stats_server = None
+        self.reuse_port = SO_REUSEPORT is not None
+        self.server = None
+        self.children = {}              # pid -> (stats pipe fd, started)
+        self.buffers = {}               # stats pipe fd -> partial line
+        self.latest = {}                # pid -> last stats line
+        self.restarts = 0
+        self.stopping = False
+
+    def run(self):
+        """ Returns (server, reporter) in each worker, never in the supervisor """
+        if not self.reuse_port:
+            self.server = self.listen(False)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if self.stats_port:
+            self.stats_server = StatsServer(self.stats_port, self.totals, self.prefix).bind()
+        for i in range(self.workers):
+            child = self._fork()
+            if child:
+                return child
+        last = time.time()
+        while True:
+            child = self._reap()
+            if child:
+                return child
+            self._read(1.0)
+            if time.time() - last >= self.interval:
+                last = time.time()
+                logging.info("workers %d, restarts %d, stats %s"
+                             % (len(self.children), self.restarts, json.dumps(self.totals())))
+
+    def _fork(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            for fd, started in self.children.values():
+                os.close(fd)
+            if self.stats_server:
+                self.stats_server.sock.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            server = self.server or self.listen(self.reuse_port)
+            return server, Reporter(w, self.interval)
+        os.close(w)
+        self.children[pid] = (r, time.time())
+        self.buffers[r] = ''
+        logging.info("started worker %d" % pid)
+        return None
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return None
+            if not pid:
+                return None
+            fd, started = self.children.pop(pid, (None, 0))
+            if fd is None:
+                continue
+            self.buffers.pop(fd, None)
+            self.latest.pop(pid, None)
+            os.close(fd)
+            if self.stopping:
+                continue
+            logging.warn("worker %d exited with status %d, restarting" % (pid, status))
+            self.restarts += 1
+            if time.time() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            child = self._fork()
+            if child:
+                return child
+
+    def _read(self, timeout):
+        fds = dict((fd, pid) for pid, (fd, started) in self.children.items())
+        listening = [self.stats_server.sock] if self.stats_server else []
+        try:
+            r, w, e = select.select(list(fds) + listening, [], [], timeout)
+        except select.error:
+            return
+        for fd in r:
+            if fd in listening:
+                try:
+                    conn, peer = fd.accept()
+                except socket.error:
+                    continue
+                self.stats_server.answer(conn)
+                continue
+            try:
+                data = os.read(fd, 65536)
+            except OSError:
+                continue
+            lines = (self.buffers.get(fd, '') + data).split('\n')
+            self.buffers[fd] = lines.pop()
+            for line in lines:
+                try:
+                    self.latest[fds[fd]] = json.loads(line)
+                except ValueError:
+                    pass
+
+    def totals(self):
+        total = {}
+        for pid, stats in self.latest.items():
+            stats = dict(stats)
+            stats.pop('pid', None)
+            merge_stats(total, stats, len(self.latest))
+        return total
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sys.exit(0)
+
+
+def supervise(workers, listen, config, stats_port=0, prefix='easysocks'):
+    """ (server, reporter) for this process; (None, None) when not running workers """
+    if workers <= 1:
+        return None, None
+    return Supervisor(workers, listen, config.get('stats_interval', 60), stats_port, prefix).run()
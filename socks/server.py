@@ -1,15 +1,22 @@
+import os
+import sys
 import logging
-import select
 import socket
 import struct
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'easysocks'))
+from relay import Relay, RelayServerMixin
+from admission import Admission, AdmissionServerMixin
+from resolver import Resolver
+from socks5 import Socks5Parser, read_message
+
 logging.basicConfig(level=logging.DEBUG)
 SOCKS_VERSION = 5
 
 
-class ThreadingTCPServer(ThreadingMixIn, TCPServer):
-    pass
+class ThreadingTCPServer(AdmissionServerMixin, RelayServerMixin, ThreadingMixIn, TCPServer):
+    reject_reply = struct.pack("!BB", SOCKS_VERSION, 0xFF)     # over capacity: no acceptable methods
 
 
 class SocksProxy(StreamRequestHandler):
@@ -19,22 +26,13 @@ class SocksProxy(StreamRequestHandler):
     def handle(self):
         logging.info('Accepting connection from %s:%s' % self.client_address)
 
-        # greeting header
-        # read and unpack 2 bytes from a client
-        header = self.connection.recv(2)
-        print(header)
-        version, nmethods = struct.unpack("!BB", header)
-
-        # socks 5
-        assert version == SOCKS_VERSION
-        assert nmethods > 0
-
-        # get available methods
-        methods = self.get_available_methods(nmethods)
+        # greeting, auth and request, possibly all in one segment
+        parser = Socks5Parser()
+        methods = read_message(self.connection, parser).methods
 
         # accept only USERNAME/PASSWORD auth
-        logging.info(set(methods))
-        if 2 not in set(methods):
+        logging.info(methods)
+        if 2 not in methods:
             # close connection
             self.server.close_request(self.request)
             return
@@ -42,23 +40,15 @@ class SocksProxy(StreamRequestHandler):
         # send welcome message
         self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, 2))
 
-        if not self.verify_credentials():
+        if not self.verify_credentials(read_message(self.connection, parser)):
             return
 
         # request
-        version, cmd, _, address_type = struct.unpack("!BBBB", self.connection.recv(4))
+        request = read_message(self.connection, parser)
+        cmd, address_type, address, port = request.cmd, request.atyp, request.host, request.port
         logging.info("cmd="+str(cmd))
-        assert version == SOCKS_VERSION
-
-        if address_type == 1:  # IPv4
-            address = socket.inet_ntop(socket.AF_INET4, self.connection.recv(16))
-        elif address_type == 4:  
-            address = socket.inet_ntop(socket.AF_INET6, self.connection.recv(16))
-        elif address_type == 3:  # Domain name
-            domain_length = self.connection.recv(1)[0]
-            address = self.connection.recv(domain_length)
-            address = socket.gethostbyname(address)
-        port = struct.unpack('!H', self.connection.recv(2))[0]
+        if address_type == 3:  # Domain name
+            address = resolver.resolve(address)[0][1]
 
         # reply
         try:
@@ -70,10 +60,9 @@ class SocksProxy(StreamRequestHandler):
             else:
                 self.server.close_request(self.request)
 
-            addr = struct.unpack("!I", socket.inet_pton(socket.AF_INET6, bind_address[0]))[0]
+            addr = socket.inet_pton(socket.AF_INET6, bind_address[0])
             port = bind_address[1]
-            reply = struct.pack("!BBBBIH", SOCKS_VERSION, 0, 0, 1,
-                                addr, port)
+            reply = struct.pack("!BBBB", SOCKS_VERSION, 0, 0, 4) + addr + struct.pack("!H", port)
 
         except Exception as err:
             logging.error(err)
@@ -84,27 +73,14 @@ class SocksProxy(StreamRequestHandler):
 
         # establish data exchange
         if reply[1] == 0 and cmd == 1:
+            remote.sendall(parser.rest())       # pipelined behind the request
             self.exchange_loop(self.connection, remote)
 
         self.server.close_request(self.request)
 
-    def get_available_methods(self, n):
-        methods = []
-        for i in range(n):
-            methods.append(ord(self.connection.recv(1)))
-        return methods
-
-    def verify_credentials(self):
-        version = ord(self.connection.recv(1))
-        assert version == 1
-
-        username_len = ord(self.connection.recv(1))
-        username = self.connection.recv(username_len).decode('utf-8')
-
-        password_len = ord(self.connection.recv(1))
-        password = self.connection.recv(password_len).decode('utf-8')
-
-        if username == self.username and password == self.password:
+    def verify_credentials(self, auth):
+        version = 1
+        if auth.username == self.username and auth.password == self.password:
             # success, status = 0
             response = struct.pack("!BB", version, 0)
             self.connection.sendall(response)
@@ -120,23 +96,16 @@ class SocksProxy(StreamRequestHandler):
         return struct.pack("!BBBBIH", SOCKS_VERSION, error_number, 0, address_type, 0, 0)
 
     def exchange_loop(self, client, remote):
-
-        while True:
-
-            # wait until client or remote is available for read
-            r, w, e = select.select([client, remote], [], [])
-
-            if client in r:
-                data = client.recv(4096)
-                if remote.send(data) <= 0:
-                    break
-
-            if remote in r:
-                data = remote.recv(4096)
-                if client.send(data) <= 0:
-                    break
+        # hand both sockets to the relay thread, the tunnel outlives this one
+        self.server.detach(self.request)
+        slot = self.server.slot(self.request)
+        slot.established(detached=True)
+        relay.add(client, remote, on_close=lambda tunnel: slot.release())
 
 
 if __name__ == '__main__':
+    relay = Relay()
+    resolver = Resolver()
     with ThreadingTCPServer(('127.0.0.1', 1040), SocksProxy) as server:
+        server.admission = Admission(max_tunnels=1024, max_handshakes=64)
         server.serve_forever()